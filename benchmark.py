@@ -0,0 +1,323 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import simulation
+
+# 基準測試：以固定種子與合成設定測量各階段的處理量 (時段/秒) 與峰值記憶體，並與基準 JSON 比較。
+# 合成設定與工作目錄中的 config.txt 無關，所有階段都使用同一份設定。
+#   python benchmark.py                     # 執行全部情境並與 benchmark_baseline.json 比較
+#   python benchmark.py --save-baseline     # 將本次結果存為基準
+#   python benchmark.py --scenarios month   # 只執行 1 個月的情境
+
+BENCHMARK_SEED = 20240401
+BENCHMARK_YEAR = 2024
+DEFAULT_BASELINE = "benchmark_baseline.json"
+MEMORY_SAMPLE_UNITS = 12  # 量測峰值記憶體時只執行的單位數
+MIN_COMPARE_SECONDS = 0.01  # 基準中短於此時間的階段計時誤差過大，不比較處理量
+
+# 合成設定：電價為高壓三段式的數值，各月份使用相同的最高需量限制，
+# 參考總需量 (kWh) = 最高需量限制 × SYNTHETIC_LOAD_FACTOR × 該月該時段的時段數 × 0.25 小時
+SYNTHETIC_BASE_DEMAND_RANGE = (15000, 30000)
+SYNTHETIC_LOW_DEMAND_RANGE = (15000, 21000)
+SYNTHETIC_MAX_DEMAND_LIMITS = {"Peak": 24000, "Half_Peak": 32000, "Saturday_Half_Peak": 28000, "Off_Peak": 31000}
+SYNTHETIC_LOAD_FACTOR = 0.7
+SYNTHETIC_BASIC_CHARGE_RATES = {
+    "Summer": {"Contract": 217.30, "Half_Peak": 160.60, "Sat_Half_Peak": 43.40, "Off_Peak": 43.40},
+    "Non_Summer": {"Contract": 0, "Half_Peak": 160.60, "Sat_Half_Peak": 43.40, "Off_Peak": 43.40}
+}
+SYNTHETIC_ENERGY_RATES = {
+    "Summer": {
+        "Weekday": {"Peak": 8.69, "Half_Peak": 5.38, "Off_Peak": 2.40},
+        "Saturday": {"Half_Peak": 2.50, "Off_Peak": 2.40},
+        "Sunday": {"Off_Peak": 2.40}
+    },
+    "Non_Summer": {
+        "Weekday": {"Half_Peak": 5.03, "Off_Peak": 2.18},
+        "Saturday": {"Half_Peak": 2.31, "Off_Peak": 2.18},
+        "Sunday": {"Off_Peak": 2.18}
+    }
+}
+
+# 情境 → (電表數, 月份)
+SCENARIOS = {
+    "month": (1, [4]),
+    "year": (1, list(range(1, 13))),
+    "fleet": (100, list(range(1, 13)))
+}
+
+STAGES = (
+    "generate_daily_demand_data",
+    "moving_average",
+    "enforce_peak_values",
+    "write_to_csv",
+    "calculate_monthly_stats_from_csv",
+    "adjust_demand_from_csv",
+    "calculate_energy_charge",
+    "plot_demand_data"
+)
+
+def synthetic_config_values():
+    """
+    建立合成設定的內容（與 config.txt 相同的鍵），參考總需量依 BENCHMARK_YEAR 各月份的時段數計算。
+
+    返回：
+        dict: {設定名稱: 值}
+    """
+    values = {
+        "METER_NO": "B0000",
+        "BASE_DEMAND_RANGE": SYNTHETIC_BASE_DEMAND_RANGE,
+        "MONTHS": {month: simulation.month_days(BENCHMARK_YEAR, month) for month in range(1, 13)},
+        "SEASONAL_ADJUSTMENT": {"Summer": 1.2, "Non-Summer": 1.0},
+        "BASIC_CHARGE_RATES": SYNTHETIC_BASIC_CHARGE_RATES,
+        "ENERGY_RATES": SYNTHETIC_ENERGY_RATES,
+        "LOW_DEMAND_START": "16:15",
+        "LOW_DEMAND_END": "22:00",
+        "LOW_DEMAND_RANGE": SYNTHETIC_LOW_DEMAND_RANGE
+    }
+    period_table = simulation.TariffSchedule(SYNTHETIC_ENERGY_RATES, SYNTHETIC_BASIC_CHARGE_RATES).period_table
+    for month, name in enumerate(simulation.MONTH_NAMES, start=1):
+        first = np.datetime64(f"{BENCHMARK_YEAR}-{month:02d}-01")
+        dates = np.arange(first, first + simulation.month_days(BENCHMARK_YEAR, month))
+        _, _, _, day_type_index, season_index = simulation.calendar_arrays(dates)
+        counts = np.bincount(period_table[season_index, day_type_index].reshape(-1), minlength=len(simulation.PERIODS))
+        values[f"MAX_DEMAND_LIMITS_{name}"] = dict(SYNTHETIC_MAX_DEMAND_LIMITS)
+        values[f"REFERENCE_TOTAL_DEMANDS_{name}"] = {
+            period: round(SYNTHETIC_MAX_DEMAND_LIMITS[period] * SYNTHETIC_LOAD_FACTOR * int(count) * 0.25)
+            for period, count in zip(simulation.PERIODS, counts)
+        }
+    return values
+
+def load_synthetic_config(directory):
+    """將合成設定寫成 directory/benchmark_config.json，並以 simulation.load_config 設為目前使用的設定。"""
+    path = os.path.join(directory, "benchmark_config.json")
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(synthetic_config_values(), file, indent=2, ensure_ascii=False)
+    return simulation.load_config(path)
+
+def synthetic_workload(meter_count, months, seed=BENCHMARK_SEED):
+    """
+    建立固定種子的合成工作量：每個 (電表, 月份) 一個單位，各有自己的每日峰值；最高需量限制與參考總需量
+    取自目前的（合成）設定，生成與調整階段使用相同的數值。
+
+    返回：
+        list: 每個單位為 {"meter_no", "year", "month", "max_demand_limits", "reference_totals", "peak_values"}
+    """
+    config = simulation.get_config()
+    rng = np.random.default_rng(seed)
+    low, high = config.base_demand_range
+    units = []
+    for meter_index in range(meter_count):
+        for month in months:
+            days = simulation.month_days(BENCHMARK_YEAR, month)
+            peak_values = {}
+            for day in range(1, days + 1):
+                slot = int(rng.integers(simulation.SLOTS_PER_DAY))
+                peak_values[f"{BENCHMARK_YEAR}-{month:02d}-{day:02d} {simulation.SLOT_TIMES[slot]}"] = round(float(rng.uniform(low, high)), 2)
+            units.append({
+                "meter_no": f"B{meter_index:04d}",
+                "year": BENCHMARK_YEAR,
+                "month": month,
+                "max_demand_limits": dict(config.max_demand_limits[month]),
+                "reference_totals": dict(config.reference_total_demands[month]),
+                "peak_values": peak_values
+            })
+    return units
+
+def run_stage(stage, unit, unit_state, work_dir, sample=False, rng=None):
+    """
+    對一個 (電表, 月份) 單位執行單一階段並回傳處理的時段數；前一階段的輸出存放在 unit_state 中。
+    繪圖每天輸出一張 PNG，只在 sample 為 True（每個情境的第一個單位）時執行。
+    rng 為生成階段使用的隨機數產生器。
+    """
+    year, month = unit["year"], unit["month"]
+    filename = os.path.join(work_dir, f"{unit['meter_no']}_{year}_{month:02d}.csv")
+
+    if stage == "generate_daily_demand_data":
+        records = simulation.generate_daily_demand_data(year, month, peak_values=unit["peak_values"], rng=rng)
+        for record in records:
+            record["meter_no"] = unit["meter_no"]
+        unit_state["records"] = records
+    elif stage == "moving_average":
+        simulation.moving_average([record["demand_kW"] for record in unit_state["records"]], window_size=5)
+    elif stage == "enforce_peak_values":
+        simulation.enforce_peak_values(unit_state["records"], unit["peak_values"], meter_no=unit["meter_no"])
+    elif stage == "write_to_csv":
+        simulation.write_to_csv(filename, unit_state["records"])
+    elif stage == "calculate_monthly_stats_from_csv":
+        stats = simulation.calculate_monthly_stats_from_csv(filename, year, month)
+        unit_state["differences"] = simulation.compare_energy_with_reference(stats, unit["reference_totals"], year, month)
+    elif stage == "adjust_demand_from_csv":
+        simulation.adjust_demand_from_csv(filename, unit_state["differences"], unit["max_demand_limits"], unit["peak_values"])
+    elif stage == "calculate_energy_charge":
+        records = unit_state["records"]
+        for start in range(0, len(records), simulation.SLOTS_PER_DAY):
+            day_records = records[start:start + simulation.SLOTS_PER_DAY]
+            simulation.calculate_energy_charge(day_records, year, month, int(day_records[0]["date"][8:10]))
+    elif stage == "plot_demand_data":
+        if not sample:
+            return 0
+        with working_directory(work_dir):
+            simulation.plot_demand_data(filename, year, month)
+    return len(unit_state["records"])
+
+@contextlib.contextmanager
+def working_directory(path):
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+def run_scenario(name, stages=STAGES, measure_memory=True, repeat=1):
+    """
+    執行一個情境，回傳 {階段: {"intervals", "seconds", "intervals_per_second", "peak_memory_mb"}}。
+
+    各單位依序跑完所有階段後即丟棄，記憶體不隨電表數增加。計時執行 repeat 次取各階段最短時間；
+    記憶體另外量測（tracemalloc 會拖慢純 Python 程式碼），只取前 MEMORY_SAMPLE_UNITS 個單位，
+    峰值為單一階段處理一個單位時的最大值。每次執行都使用相同的種子。
+    """
+    meter_count, months = SCENARIOS[name]
+    units = synthetic_workload(meter_count, months)
+    results = {stage: {"intervals": 0, "seconds": None} for stage in stages}
+
+    passes = [False] * repeat + ([True] if measure_memory else [])
+    for tracing in passes:
+        rng = np.random.default_rng(BENCHMARK_SEED)
+        work_dir = tempfile.mkdtemp(prefix=f"benchmark_{name}_")
+        peaks = dict.fromkeys(stages, 0)
+        intervals = dict.fromkeys(stages, 0)
+        seconds = dict.fromkeys(stages, 0.0)
+        if tracing:
+            tracemalloc.start()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                for unit_index, unit in enumerate(units[:MEMORY_SAMPLE_UNITS] if tracing else units):
+                    unit_state = {}
+                    for stage in stages:
+                        if tracing:
+                            tracemalloc.reset_peak()
+                            baseline_memory = tracemalloc.get_traced_memory()[0]
+                            run_stage(stage, unit, unit_state, work_dir, sample=unit_index == 0, rng=rng)
+                            peaks[stage] = max(peaks[stage], tracemalloc.get_traced_memory()[1] - baseline_memory)
+                        else:
+                            start = time.perf_counter()
+                            intervals[stage] += run_stage(stage, unit, unit_state, work_dir, sample=unit_index == 0, rng=rng)
+                            seconds[stage] += time.perf_counter() - start
+        finally:
+            if tracing:
+                tracemalloc.stop()
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        for stage in stages:
+            if tracing:
+                results[stage]["peak_memory_mb"] = round(peaks[stage] / 2 ** 20, 2)
+            elif results[stage]["seconds"] is None or seconds[stage] < results[stage]["seconds"]:
+                results[stage].update(intervals=intervals[stage], seconds=seconds[stage])
+
+    for result in results.values():
+        elapsed = result["seconds"]
+        result["seconds"] = round(elapsed, 4)
+        result["intervals_per_second"] = round(result["intervals"] / elapsed, 1) if elapsed > 0 else None
+    return results
+
+def compare_with_baseline(results, baseline, tolerance):
+    """
+    與基準比較，處理量低於基準 (1 - tolerance) 倍或峰值記憶體高於基準 (1 + tolerance) 倍即視為退步。
+    基準中執行時間短於 MIN_COMPARE_SECONDS 的階段只比較記憶體。
+
+    返回：
+        list: 退步項目的說明文字
+    """
+    regressions = []
+    for scenario, stages in results.items():
+        for stage, result in stages.items():
+            reference = baseline.get("results", {}).get(scenario, {}).get(stage)
+            if not reference:
+                continue
+            throughput, reference_throughput = result.get("intervals_per_second"), reference.get("intervals_per_second")
+            timed = reference.get("seconds", 0) >= MIN_COMPARE_SECONDS
+            if timed and throughput and reference_throughput and throughput < reference_throughput * (1 - tolerance):
+                regressions.append(f"{scenario}/{stage}：處理量 {throughput:,.0f} 低於基準 {reference_throughput:,.0f} 時段/秒")
+            memory, reference_memory = result.get("peak_memory_mb"), reference.get("peak_memory_mb")
+            if memory and reference_memory and memory > reference_memory * (1 + tolerance):
+                regressions.append(f"{scenario}/{stage}：峰值記憶體 {memory:,.2f} 高於基準 {reference_memory:,.2f} MB")
+    return regressions
+
+def print_results(name, results):
+    print(f"\n情境 {name}（{SCENARIOS[name][0]} 個電表 × {len(SCENARIOS[name][1])} 個月）：")
+    print(f"  {'階段':<34}{'時段數':>10}{'秒':>10}{'時段/秒':>14}{'峰值 MB':>10}")
+    for stage, result in results.items():
+        throughput = result.get("intervals_per_second")
+        print(f"  {stage:<34}{result['intervals']:>10,}{result['seconds']:>10.3f}"
+              f"{throughput if throughput is None else format(throughput, ',.0f'):>14}{result.get('peak_memory_mb', '-'):>10}")
+
+def main(scenarios=None, baseline=DEFAULT_BASELINE, save_baseline=False, tolerance=0.2, measure_memory=True, repeat=3):
+    """
+    執行基準測試。
+
+    參數：
+        scenarios (list): 要執行的情境，None 時執行全部
+        baseline (str): 基準 JSON 路徑
+        save_baseline (bool): 是否將本次結果寫入基準
+        tolerance (float): 判定退步的容許比例
+        measure_memory (bool): 是否另外執行一次以量測峰值記憶體
+        repeat (int): 計時的重複次數（fleet 情境固定 1 次），取最短時間
+
+    返回：
+        int: 結束代碼，有退步時為 1
+    """
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="benchmark_config_") as config_dir:
+        load_synthetic_config(config_dir)
+        for name in scenarios or SCENARIOS:
+            results[name] = run_scenario(name, measure_memory=measure_memory, repeat=1 if name == "fleet" else repeat)
+            print_results(name, results[name])
+
+    if save_baseline:
+        document = {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "seed": BENCHMARK_SEED,
+            "results": results
+        }
+        with open(baseline, "w", encoding="utf-8") as file:
+            json.dump(document, file, indent=2, ensure_ascii=False)
+        print(f"\n基準已保存到 {baseline}")
+        return 0
+
+    if not os.path.exists(baseline):
+        print(f"\n找不到基準 {baseline}，以 --save-baseline 建立")
+        return 0
+    with open(baseline, "r", encoding="utf-8") as file:
+        regressions = compare_with_baseline(results, json.load(file), tolerance)
+    if regressions:
+        print("\n效能退步：")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    print(f"\n與基準 {baseline} 相比沒有退步（容許 {tolerance:.0%}）")
+    return 0
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="需量模擬的基準測試")
+    parser.add_argument("--scenarios", nargs="+", choices=tuple(SCENARIOS), default=None, help="要執行的情境")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="基準 JSON 路徑")
+    parser.add_argument("--save-baseline", action="store_true", help="將本次結果存為基準")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="判定退步的容許比例")
+    parser.add_argument("--repeat", type=int, default=3, help="計時的重複次數，取最短時間")
+    parser.add_argument("--no-memory", dest="measure_memory", action="store_false", help="不量測峰值記憶體")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    sys.exit(main(**vars(parse_args())))
@@ -1,73 +1,443 @@
+import argparse
+import ast
+import calendar
+import contextlib
+import hashlib
+import io
+import json
 import random
-import matplotlib.pyplot as plt
-from datetime import datetime
+import numpy as np
+from datetime import datetime, date, timedelta
 import csv
+import functools
+import glob
+import gzip
 import os
+import queue
+import sqlite3
+import struct
+import threading
 import time
+import tracemalloc
+import types
+from concurrent.futures import ProcessPoolExecutor
+
+# 參數設置：config.txt 在第一次使用時才載入（見 get_config）
+CONFIG_PATH = "config.txt"
+DEFAULT_YEAR = 2024  # 沒有指定年份、PEAK_VALUES 也沒有日期時使用的年份
+SMOOTHING_WINDOW = 5  # 生成需量時的移動平均視窗
+STREAM_CHUNK_DAYS = 7  # 串流流程每塊的天數
+SCENARIO_PERCENTILES = (5, 50, 95)
+SCENARIO_BATCH_SIZE = 256  # 蒙地卡羅情境每批的路徑數，限制 (情境 × 時段) 陣列的記憶體
+MONTH_NAMES = ("JANUARY", "FEBRUARY", "MARCH", "APRIL", "MAY", "JUNE",
+               "JULY", "AUGUST", "SEPTEMBER", "OCTOBER", "NOVEMBER", "DECEMBER")
+REQUIRED_CONFIG_KEYS = ("METER_NO", "BASE_DEMAND_RANGE", "MONTHS", "SEASONAL_ADJUSTMENT", "BASIC_CHARGE_RATES",
+                        "ENERGY_RATES", "LOW_DEMAND_START", "LOW_DEMAND_END", "LOW_DEMAND_RANGE")
+
+# 舊版模組層級名稱 → SimulationConfig 屬性，保留 simulation.PEAK_VALUES_DICT 等寫法
+LEGACY_CONFIG_NAMES = {
+    "METER_NO": "meter_no",
+    "BASE_DEMAND_RANGE": "base_demand_range",
+    "MONTHS": "months",
+    "SEASONAL_ADJUSTMENT": "seasonal_adjustment",
+    "BASIC_CHARGE_RATES": "basic_charge_rates",
+    "ENERGY_RATES": "energy_rates",
+    "LOW_DEMAND_START": "low_demand_start",
+    "LOW_DEMAND_END": "low_demand_end",
+    "LOW_DEMAND_RANGE": "low_demand_range",
+    "PEAK_VALUES_DICT": "peak_values",
+    "REFERENCE_TOTAL_DEMANDS_DICT": "reference_total_demands",
+    "MAX_DEMAND_LIMITS_DICT": "max_demand_limits",
+    "MAX_DEMAND_LIMITS_TABLE": "max_demand_limits_table",
+    "REFERENCE_TOTAL_DEMANDS_TABLE": "reference_total_demands_table",
+    "TARIFF_SCHEDULE": "tariff_schedule",
+    "LOW_DEMAND_MASK": "low_demand_mask"
+}
 
-# 設置中文字體
-plt.rcParams['font.sans-serif'] = ['Noto Sans CJK JP', 'Noto Serif CJK JP', 'DejaVu Sans']  # 按優先順序嘗試
-plt.rcParams['axes.unicode_minus'] = False  # 解決負號顯示問題
+def freeze(value):
+    """遞迴地將 dict / list 轉為唯讀的 MappingProxyType / tuple。"""
+    if isinstance(value, dict):
+        return types.MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
 
-# 參數設置
-config = {}
+def parse_config_text(text, filename=CONFIG_PATH):
+    """
+    解析 config.txt。檔案只允許 `名稱 = 常值` 形式的指派，以 ast.literal_eval 求值，不執行任何程式碼。
 
-with open("config.txt", "r", encoding="utf-8") as file:
-    exec(file.read(), config)
+    返回：
+        dict: {名稱: 值}
+    """
+    values = {}
+    for node in ast.parse(text, filename=filename).body:
+        if not (isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name)):
+            raise ValueError(f"{filename}:{node.lineno}: 只允許「名稱 = 常值」的設定")
+        try:
+            values[node.targets[0].id] = ast.literal_eval(node.value)
+        except ValueError:
+            raise ValueError(f"{filename}:{node.lineno}: {node.targets[0].id} 的值必須是常值") from None
+    return values
+
+def parse_config_file(path, data):
+    """依副檔名解析設定檔：.json、.toml，其餘視為 config.txt 格式。"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".json":
+        return json.loads(data.decode("utf-8"))
+    if extension == ".toml":
+        import tomllib
+        return tomllib.loads(data.decode("utf-8"))
+    return parse_config_text(data.decode("utf-8"), filename=path)
+
+class SimulationConfig:
+    """
+    驗證後的唯讀設定。字典類設定以 MappingProxyType 凍結，月份表格為唯讀的 (13, 4) 陣列，
+    電價表 (TariffSchedule) 與低需求遮罩在第一次使用時才建立。
+    """
 
-# 讀取變數
-METER_NO = config["METER_NO"]
-BASE_DEMAND_RANGE = config["BASE_DEMAND_RANGE"]
-MONTHS = config["MONTHS"]
-SEASONAL_ADJUSTMENT = config["SEASONAL_ADJUSTMENT"]
-BASIC_CHARGE_RATES = config["BASIC_CHARGE_RATES"]
-ENERGY_RATES = config["ENERGY_RATES"]
+    def __init__(self, values, source=CONFIG_PATH):
+        missing = [key for key in REQUIRED_CONFIG_KEYS if key not in values]
+        if missing:
+            raise ValueError(f"{source}: 缺少設定 {', '.join(missing)}")
+
+        def check_range(name):
+            value = values[name]
+            if len(value) != 2 or not all(isinstance(bound, (int, float)) for bound in value) or value[0] > value[1]:
+                raise ValueError(f"{source}: {name} 必須是 (下限, 上限)")
+            return tuple(value)
+
+        def check_time(name):
+            value = values[name]
+            try:
+                hour, minute = map(int, value.split(":"))
+            except (AttributeError, ValueError):
+                raise ValueError(f"{source}: {name} 必須是 HH:MM 格式") from None
+            if not (0 <= hour < 24 and 0 <= minute < 60):
+                raise ValueError(f"{source}: {name} 必須是 HH:MM 格式")
+            return f"{hour:02d}:{minute:02d}"
+
+        def monthly(prefix, required=False):
+            tables = {}
+            for month, name in enumerate(MONTH_NAMES, start=1):
+                key = f"{prefix}_{name}"
+                if key in values:
+                    tables[month] = values[key]
+                elif required:
+                    raise ValueError(f"{source}: 缺少設定 {key}")
+            return tables
+
+        def check_period_values(name, tables):
+            for month, table in tables.items():
+                for period in PERIODS:
+                    if not isinstance(table.get(period), (int, float)) or table[period] < 0:
+                        raise ValueError(f"{source}: {name}_{MONTH_NAMES[month - 1]} 缺少 {period} 或數值不正確")
+
+        months = {int(month): int(days) for month, days in values["MONTHS"].items()}
+        if sorted(months) != list(range(1, 13)):
+            raise ValueError(f"{source}: MONTHS 必須包含 1 到 12 月")
+        for season in SEASONS:
+            if season not in values["BASIC_CHARGE_RATES"] or season not in values["ENERGY_RATES"]:
+                raise ValueError(f"{source}: 電價設定缺少 {season}")
+
+        # 每個月份都必須有需量上限與參考總需量，否則模擬時會得到全為 0 的需量
+        reference_total_demands = monthly("REFERENCE_TOTAL_DEMANDS", required=True)
+        max_demand_limits = monthly("MAX_DEMAND_LIMITS", required=True)
+        check_period_values("REFERENCE_TOTAL_DEMANDS", reference_total_demands)
+        check_period_values("MAX_DEMAND_LIMITS", max_demand_limits)
+
+        self.source = source
+        self.meter_no = str(values["METER_NO"])
+        self.base_demand_range = check_range("BASE_DEMAND_RANGE")
+        self.low_demand_range = check_range("LOW_DEMAND_RANGE")
+        self.low_demand_start = check_time("LOW_DEMAND_START")
+        self.low_demand_end = check_time("LOW_DEMAND_END")
+        self.months = freeze(months)
+        self.seasonal_adjustment = freeze(values["SEASONAL_ADJUSTMENT"])
+        self.basic_charge_rates = freeze(values["BASIC_CHARGE_RATES"])
+        self.energy_rates = freeze(values["ENERGY_RATES"])
+        self.peak_values = freeze(monthly("PEAK_VALUES"))
+        self.reference_total_demands = freeze(reference_total_demands)
+        self.max_demand_limits = freeze(max_demand_limits)
+
+        # (月份, 時段代碼) → 最高需量限制 / 參考總需量 (kWh)
+        self.max_demand_limits_table = monthly_period_table(max_demand_limits)
+        self.reference_total_demands_table = monthly_period_table(reference_total_demands)
+        self.max_demand_limits_table.flags.writeable = False
+        self.reference_total_demands_table.flags.writeable = False
+
+        self._tariff_schedule = None
+        self._low_demand_mask = None
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, "_frozen", False) and not name.startswith("_"):
+            raise AttributeError(f"SimulationConfig 為唯讀，不能設定 {name}")
+        object.__setattr__(self, name, value)
+
+    @property
+    def tariff_schedule(self):
+        if self._tariff_schedule is None:
+            self._tariff_schedule = TariffSchedule(self.energy_rates, self.basic_charge_rates)
+        return self._tariff_schedule
+
+    @property
+    def low_demand_mask(self):
+        if self._low_demand_mask is None:
+            mask = np.array([self.low_demand_start <= slot_time <= self.low_demand_end for slot_time in SLOT_TIMES])
+            mask.flags.writeable = False
+            self._low_demand_mask = mask
+        return self._low_demand_mask
+
+_config = None
+_config_files = {}  # 路徑 → (mtime_ns, size, sha256, SimulationConfig)
+
+def load_config(path=None):
+    """
+    載入並驗證設定檔，並設為目前使用的設定。同一路徑以 mtime 與檔案大小判斷是否需要重新讀取，
+    內容雜湊相同時沿用已解析的結果。
 
-LOW_DEMAND_START = config["LOW_DEMAND_START"]
-LOW_DEMAND_END = config["LOW_DEMAND_END"]
-LOW_DEMAND_RANGE = config["LOW_DEMAND_RANGE"]
+    參數：
+        path (str): 設定檔路徑，None 時為 CONFIG_PATH
 
-PEAK_VALUES_DICT = {
-    4: config["PEAK_VALUES_APRIL"],
-    5: config["PEAK_VALUES_MAY"],
-    7: config["PEAK_VALUES_JULY"]
-}
+    返回：
+        SimulationConfig: 設定
+    """
+    global _config
+    path = CONFIG_PATH if path is None else path
+    stat = os.stat(path)
+    cached = _config_files.get(path)
+    if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        _config = cached[3]
+        return _config
+
+    with open(path, "rb") as file:
+        data = file.read()
+    digest = hashlib.sha256(data).hexdigest()
+    if cached is not None and cached[2] == digest:
+        loaded = cached[3]
+    else:
+        loaded = SimulationConfig(parse_config_file(path, data), source=path)
+    _config_files[path] = (stat.st_mtime_ns, stat.st_size, digest, loaded)
+    _config = loaded
+    return _config
+
+def get_config():
+    """回傳目前的設定，第一次呼叫時才讀取 CONFIG_PATH。"""
+    return _config if _config is not None else load_config()
+
+def __getattr__(name):
+    if name in LEGACY_CONFIG_NAMES:
+        return getattr(get_config(), LEGACY_CONFIG_NAMES[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# 效能追蹤：預設關閉（_trace 為 None），被 @traced 包裝的函式只多一次全域變數檢查。
+# 啟用後各行程把 (年, 月, 電表, 階段) 的呼叫次數、時間與計數器累加在記憶體中，
+# flush_trace 時附加到 trace 目錄下的 trace-<pid>.jsonl，最後由 summarize_trace 合併。
+TRACE_COUNTERS = ("rows", "bytes_read", "bytes_written", "figures")
+TRACE_FIELDS = ("pid", "year", "month", "meter_no", "stage", "calls", "seconds", "peak_memory_bytes") + TRACE_COUNTERS
+
+class Trace:
+    """
+    單一行程的追蹤紀錄。時間包含巢狀的子階段；memory 為 True 時以 tracemalloc 量測各階段的峰值記憶體增量
+    （會明顯拖慢純 Python 程式碼，只在需要時開啟）。
+    """
 
-REFERENCE_TOTAL_DEMANDS_DICT = {
-    1: config["REFERENCE_TOTAL_DEMANDS_JANUARY"],
-    2: config["REFERENCE_TOTAL_DEMANDS_FEBRUARY"],
-    3: config["REFERENCE_TOTAL_DEMANDS_MARCH"],
-    4: config["REFERENCE_TOTAL_DEMANDS_APRIL"],
-    5: config["REFERENCE_TOTAL_DEMANDS_MAY"],
-    6: config["REFERENCE_TOTAL_DEMANDS_JUNE"],
-    7: config["REFERENCE_TOTAL_DEMANDS_JULY"],
-    8: config["REFERENCE_TOTAL_DEMANDS_AUGUST"],
-    9: config["REFERENCE_TOTAL_DEMANDS_SEPTEMBER"],
-    10: config["REFERENCE_TOTAL_DEMANDS_OCTOBER"],
-    11: config["REFERENCE_TOTAL_DEMANDS_NOVEMBER"],
-    12: config["REFERENCE_TOTAL_DEMANDS_DECEMBER"],
-}
+    def __init__(self, directory, memory=False):
+        self.directory = directory
+        self.memory = memory
+        self.pid = os.getpid()
+        self.context = {"year": None, "month": None, "meter_no": None}
+        self.records = {}
+        self.stack = []
+
+    def entry(self, stage):
+        if self.pid != os.getpid():
+            # fork 出的 worker 繼承了父行程的紀錄，捨棄後重新累加
+            self.pid = os.getpid()
+            self.records = {}
+            self.stack = []
+        key = (self.context["year"], self.context["month"], self.context["meter_no"], stage)
+        entry = self.records.get(key)
+        if entry is None:
+            entry = self.records[key] = dict.fromkeys(("calls", "seconds", "peak_memory_bytes") + TRACE_COUNTERS, 0)
+        return entry
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        """記錄一次階段執行；期間 count() 的計數器記在此階段。"""
+        entry = self.entry(stage)
+        memory = self.memory and tracemalloc.is_tracing()
+        frame = [entry, 0, 0]  # [紀錄, 期間的峰值記憶體, 開始時的記憶體]
+        if memory:
+            frame[2], peak = tracemalloc.get_traced_memory()
+            if self.stack:
+                self.stack[-1][1] = max(self.stack[-1][1], peak)
+            tracemalloc.reset_peak()
+        self.stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            entry["seconds"] += time.perf_counter() - start
+            entry["calls"] += 1
+            self.stack.pop()
+            if memory:
+                # 子階段會重設峰值，所以把各段的峰值往外層傳
+                peak = max(frame[1], tracemalloc.get_traced_memory()[1])
+                entry["peak_memory_bytes"] = max(entry["peak_memory_bytes"], peak - frame[2])
+                if self.stack:
+                    self.stack[-1][1] = max(self.stack[-1][1], peak)
+
+    def count(self, stage=None, **counters):
+        """累加計數器到 stage，None 時記在目前執行中的階段。"""
+        if stage is not None:
+            entry = self.entry(stage)
+            entry["calls"] += 1
+        elif self.stack:
+            entry = self.stack[-1][0]
+        else:
+            return
+        for name, value in counters.items():
+            entry[name] += value
 
-MAX_DEMAND_LIMITS_DICT = {
-    1: config["MAX_DEMAND_LIMITS_JANUARY"],
-    2: config["MAX_DEMAND_LIMITS_FEBRUARY"],
-    3: config["MAX_DEMAND_LIMITS_MARCH"],
-    4: config["MAX_DEMAND_LIMITS_APRIL"],
-    5: config["MAX_DEMAND_LIMITS_MAY"],
-    6: config["MAX_DEMAND_LIMITS_JUNE"],
-    7: config["MAX_DEMAND_LIMITS_JULY"],
-    8: config["MAX_DEMAND_LIMITS_AUGUST"],
-    9: config["MAX_DEMAND_LIMITS_SEPTEMBER"],
-    10: config["MAX_DEMAND_LIMITS_OCTOBER"],
-    11: config["MAX_DEMAND_LIMITS_NOVEMBER"],
-    12: config["MAX_DEMAND_LIMITS_DECEMBER"],
-}
+    def rows(self):
+        return [dict(zip(("year", "month", "meter_no", "stage"), key), pid=self.pid, **entry) for key, entry in self.records.items()]
+
+    def flush(self):
+        """把累積的紀錄附加到 trace-<pid>.jsonl 並清空，須在所有階段結束後呼叫。"""
+        if self.pid != os.getpid() or not self.records:
+            return
+        with open(os.path.join(self.directory, f"trace-{self.pid}.jsonl"), "a", encoding="utf-8") as file:
+            for row in self.rows():
+                file.write(json.dumps(row, ensure_ascii=False) + "\n")
+        self.records = {}
+
+_trace = None
+
+def enable_tracing(directory, memory=False, clear=True):
+    """
+    開啟本行程的效能追蹤，清除 directory 中上次執行留下的 trace-*.jsonl。worker 行程由 worker_pool 以相同設定開啟。
+
+    參數：
+        directory (str): 追蹤輸出目錄
+        memory (bool): 是否以 tracemalloc 量測各階段的峰值記憶體
+        clear (bool): 是否清除舊的 trace-*.jsonl；worker 行程為 False，以免刪掉其他行程的紀錄
+    """
+    global _trace
+    os.makedirs(directory, exist_ok=True)
+    if clear:
+        for path in glob.glob(os.path.join(directory, "trace-*.jsonl")):
+            os.remove(path)
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _trace = Trace(directory, memory)
+    return _trace
+
+def disable_tracing():
+    """寫出剩餘紀錄並關閉追蹤。"""
+    global _trace
+    if _trace is not None:
+        _trace.flush()
+        if _trace.memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+    _trace = None
+
+def flush_trace():
+    if _trace is not None:
+        _trace.flush()
+
+def traced(stage):
+    """將函式標記為一個追蹤階段；關閉追蹤時直接呼叫原函式。"""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _trace is None:
+                return func(*args, **kwargs)
+            with _trace.stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+_no_trace = contextlib.nullcontext()
+
+def trace_stage(stage):
+    """以 with 區塊記錄一個階段，用於不是整個函式的流程；關閉追蹤時回傳共用的空 context manager。"""
+    return _no_trace if _trace is None else _trace.stage(stage)
+
+def trace_count(stage=None, **counters):
+    """累加 rows、bytes_read、bytes_written 或 figures 計數器；關閉追蹤時不做任何事。"""
+    if _trace is not None:
+        _trace.count(stage, **counters)
+
+@contextlib.contextmanager
+def trace_context(**context):
+    """在區塊內把紀錄歸到指定的 year、month 或 meter_no。"""
+    if _trace is None:
+        yield
+        return
+    previous = dict(_trace.context)
+    _trace.context.update(context)
+    try:
+        yield
+    finally:
+        _trace.context = previous
+
+def summarize_trace(directory):
+    """
+    合併 directory 中所有行程的 trace-*.jsonl，寫出 trace.csv（每列一個 行程 × 年月 × 電表 × 階段）
+    與 trace_summary.json（依階段加總）。
+
+    返回：
+        dict: {階段: {"calls", "seconds", "peak_memory_bytes", "rows", "bytes_read", "bytes_written", "figures"}}
+    """
+    rows = []
+    for path in sorted(glob.glob(os.path.join(directory, "trace-*.jsonl"))):
+        with open(path, "r", encoding="utf-8") as file:
+            rows.extend(json.loads(line) for line in file if line.strip())
+
+    with open(os.path.join(directory, "trace.csv"), "w", newline="", encoding="utf-8") as file:
+        writer = csv.DictWriter(file, fieldnames=TRACE_FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(dict(row, seconds=round(row["seconds"], 6)))
+
+    summary = {}
+    for row in rows:
+        entry = summary.setdefault(row["stage"], dict.fromkeys(("calls", "seconds", "peak_memory_bytes") + TRACE_COUNTERS, 0))
+        for name in ("calls", "seconds") + TRACE_COUNTERS:
+            entry[name] += row[name]
+        entry["peak_memory_bytes"] = max(entry["peak_memory_bytes"], row["peak_memory_bytes"])
+    for entry in summary.values():
+        entry["seconds"] = round(entry["seconds"], 6)
+    with open(os.path.join(directory, "trace_summary.json"), "w", encoding="utf-8") as file:
+        json.dump({"processes": len({row["pid"] for row in rows}), "stages": summary}, file, indent=2, ensure_ascii=False)
+    return summary
+
+def init_worker(config_path, trace_directory=None, trace_memory=False):
+    """worker 行程的初始化函式：載入與主行程相同的設定檔並沿用追蹤設定，不依賴 fork 繼承的全域狀態。"""
+    load_config(config_path)
+    if trace_directory is not None:
+        enable_tracing(trace_directory, memory=trace_memory, clear=False)
+
+def worker_pool(workers):
+    """
+    建立 ProcessPoolExecutor，worker 啟動時以 init_worker 套用目前的設定檔路徑與追蹤設定，
+    在 spawn 啟動方式下也不會改讀預設的 config.txt。
+
+    參數：
+        workers (int): 行程數
+
+    返回：
+        ProcessPoolExecutor: 行程池
+    """
+    trace = (None, False) if _trace is None else (_trace.directory, _trace.memory)
+    return ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(get_config().source,) + trace)
 
 def time_to_minutes(time_str):
     hour, minute = map(int, time_str.split(":"))
     return hour * 60 + minute
 
-def generate_random_demand(period, max_demand_limits, peak_value,is_low_demand=False):
+def generate_random_demand(period, max_demand_limits, peak_value,is_low_demand=False, rng=None):
     """
     根據時段生成隨機需求量，確保不超過 peak_value 和時段最高需量限制。
 
@@ -75,46 +445,401 @@ def generate_random_demand(period, max_demand_limits, peak_value,is_low_demand=F
         period (str): 時段類型 ("Peak", "Half_Peak", "Saturday_Half_Peak", "Off_Peak")
         peak_value (float): 當日高峰值 (kW)
         is_low_demand (bool): 是否為低需求時段
+        rng (np.random.Generator): 隨機數產生器，None 時使用全域 random
 
     返回：
         float: 隨機生成的需求量 (kW)
     """
+    config = get_config()
     # 獲取時段的最高需量限制（從 config.txt 讀取）
     max_demand_limit = max_demand_limits[period]
 
     if peak_value == None :
-       peak_value = BASE_DEMAND_RANGE[0]*1.5
+       peak_value = config.base_demand_range[0]*1.5
 
     # 根據時段設置隨機範圍
     if is_low_demand:
         # 低需求時段使用 LOW_DEMAND_RANGE，但不超過 peak_value 和時段限制
-        upper_bound = min(LOW_DEMAND_RANGE[1], peak_value, max_demand_limit)
-        lower_bound = min(LOW_DEMAND_RANGE[0], peak_value, max_demand_limit)
+        upper_bound = min(config.low_demand_range[1], peak_value, max_demand_limit)
+        lower_bound = min(config.low_demand_range[0], peak_value, max_demand_limit)
     else:
         # 根據時段調整範圍
         if period == "Peak":
             # 尖峰時段：接近 peak_value，但不超過時段限制
-            lower_bound = min(BASE_DEMAND_RANGE[0], peak_value, max_demand_limit)
-            upper_bound = min(BASE_DEMAND_RANGE[1], peak_value, max_demand_limit)
+            lower_bound = min(config.base_demand_range[0], peak_value, max_demand_limit)
+            upper_bound = min(config.base_demand_range[1], peak_value, max_demand_limit)
         elif period == "Half_Peak":
             # 半尖峰時段：中等範圍
-            lower_bound = min(BASE_DEMAND_RANGE[0], peak_value, max_demand_limit)
-            upper_bound = min(BASE_DEMAND_RANGE[1], peak_value, max_demand_limit)
+            lower_bound = min(config.base_demand_range[0], peak_value, max_demand_limit)
+            upper_bound = min(config.base_demand_range[1], peak_value, max_demand_limit)
         elif period == "Saturday_Half_Peak":
             # 週六半尖峰：略低於半尖峰
-            lower_bound = min(BASE_DEMAND_RANGE[0], peak_value, max_demand_limit)
-            upper_bound = min(BASE_DEMAND_RANGE[1], peak_value, max_demand_limit)
+            lower_bound = min(config.base_demand_range[0], peak_value, max_demand_limit)
+            upper_bound = min(config.base_demand_range[1], peak_value, max_demand_limit)
         else:  # Off_Peak
             # 離峰時段：降低範圍
-            lower_bound = min(BASE_DEMAND_RANGE[0], peak_value, max_demand_limit)  # 降低下限
-            upper_bound = min(BASE_DEMAND_RANGE[1], peak_value, max_demand_limit)  # 降低上限
+            lower_bound = min(config.base_demand_range[0], peak_value, max_demand_limit)  # 降低下限
+            upper_bound = min(config.base_demand_range[1], peak_value, max_demand_limit)  # 降低上限
 
     # 確保下限不超過上限
     lower_bound = min(lower_bound, upper_bound)
-    demand = random.uniform(lower_bound, upper_bound)
+    demand = random.uniform(lower_bound, upper_bound) if rng is None else rng.uniform(lower_bound, upper_bound)
 
     return round(demand, 2)
 
+# 陣列引擎使用的時段代碼與查表
+PERIODS = ("Peak", "Half_Peak", "Saturday_Half_Peak", "Off_Peak")
+PERIOD_CODES = {period: code for code, period in enumerate(PERIODS)}
+DAY_TYPES = ("Weekday", "Saturday", "Sunday")
+SEASONS = ("Summer", "Non_Summer")
+SLOTS_PER_DAY = 96  # 每天 96 個 15 分鐘時段
+SLOT_TIMES = [f"{slot // 4:02d}:{slot % 4 * 15:02d}" for slot in range(SLOTS_PER_DAY)]
+
+_rng = np.random.default_rng()
+
+def classify_period(day_type, season, time_minutes):
+    """
+    依日別、季節與當日分鐘數判斷時間電價時段。
+
+    參數：
+        day_type (str): "Weekday"、"Saturday" 或 "Sunday"
+        season (str): "Summer" 或 "Non_Summer"
+        time_minutes (int): 自 00:00 起算的分鐘數
+
+    返回：
+        str: "Peak"、"Half_Peak"、"Saturday_Half_Peak" 或 "Off_Peak"
+    """
+    if day_type == "Weekday":
+        if season == "Summer":
+            if 16 * 60 <= time_minutes < 22 * 60:  # 16:00-22:00
+                return "Peak"
+            elif (9 * 60 <= time_minutes < 16 * 60) or (22 * 60 <= time_minutes < 24 * 60):  # 09:00-16:00, 22:00-24:00
+                return "Half_Peak"
+            else:  # 00:00-09:00
+                return "Off_Peak"
+        else:  # Non-Summer
+            if (6 * 60 <= time_minutes < 11 * 60) or (14 * 60 <= time_minutes < 24 * 60):  # 06:00-11:00, 14:00-24:00
+                return "Half_Peak"
+            else:  # 00:00-06:00, 11:00-14:00
+                return "Off_Peak"
+    elif day_type == "Saturday":
+        if season == "Summer":
+            if 9 * 60 <= time_minutes < 24 * 60:  # 09:00-24:00
+                return "Saturday_Half_Peak"
+            else:  # 00:00-09:00
+                return "Off_Peak"
+        else:  # Non-Summer
+            if (6 * 60 <= time_minutes < 11 * 60) or (14 * 60 <= time_minutes < 24 * 60):  # 06:00-11:00, 14:00-24:00
+                return "Saturday_Half_Peak"
+            else:  # 00:00-06:00, 11:00-14:00
+                return "Off_Peak"
+    else:  # Sunday
+        return "Off_Peak"
+
+def is_summer_day(month, day):
+    """夏月為 5/16 至 10/15。"""
+    return (month > 5 or (month == 5 and day >= 16)) and (month < 10 or (month == 10 and day <= 15))
+
+class TariffSchedule:
+    """
+    由 config.txt 的電價設定編譯而成的時間電價表，供需量生成、電費計算與繪圖共用。
+
+    屬性：
+        period_table (np.ndarray): (季節, 日別, 時段) → 時段代碼，形狀為 (2, 3, 96)
+        rate_index_table (np.ndarray): (季節, 日別, 時段) → energy_rates 的索引
+        energy_rates (np.ndarray): 攤平的流動電價 (元/kWh)，索引為 (季節, 日別, 時段代碼)
+    """
+
+    def __init__(self, energy_rates, basic_charge_rates):
+        self.basic_charge_rates = basic_charge_rates
+        self.period_table = np.empty((len(SEASONS), len(DAY_TYPES), SLOTS_PER_DAY), dtype=np.uint8)
+        for season_index, season in enumerate(SEASONS):
+            for day_type_index, day_type in enumerate(DAY_TYPES):
+                for slot in range(SLOTS_PER_DAY):
+                    period = classify_period(day_type, season, slot * 15)
+                    self.period_table[season_index, day_type_index, slot] = PERIOD_CODES[period]
+
+        # 週六半尖峰在 ENERGY_RATES 中記為 "Half_Peak"
+        self.energy_rates = np.zeros(len(SEASONS) * len(DAY_TYPES) * len(PERIODS))
+        for season_index, season in enumerate(SEASONS):
+            for day_type_index, day_type in enumerate(DAY_TYPES):
+                rates = energy_rates[season][day_type]
+                for code, period in enumerate(PERIODS):
+                    rate_key = "Half_Peak" if period == "Saturday_Half_Peak" else period
+                    index = (season_index * len(DAY_TYPES) + day_type_index) * len(PERIODS) + code
+                    self.energy_rates[index] = rates.get(rate_key, 0.0)
+
+        base_index = (np.arange(len(SEASONS))[:, None] * len(DAY_TYPES) + np.arange(len(DAY_TYPES))[None, :]) * len(PERIODS)
+        self.rate_index_table = (base_index[:, :, None] + self.period_table).astype(np.int16)
+
+        self._calendar = {}
+
+    def day_info(self, year, month, day):
+        """
+        回傳 (weekday, day_type_index, season_index)，同一日期只計算一次。
+        """
+        key = (year, month, day)
+        info = self._calendar.get(key)
+        if info is None:
+            weekday = datetime(year, month, day).weekday()
+            info = (weekday, min(max(weekday - 4, 0), 2), 0 if is_summer_day(month, day) else 1)
+            self._calendar[key] = info
+        return info
+
+    def season(self, year, month, day):
+        return SEASONS[self.day_info(year, month, day)[2]]
+
+    def day_type(self, year, month, day):
+        return DAY_TYPES[self.day_info(year, month, day)[1]]
+
+    def day_periods(self, year, month, day):
+        """回傳該日 96 個時段的時段代碼。"""
+        _, day_type_index, season_index = self.day_info(year, month, day)
+        return self.period_table[season_index, day_type_index]
+
+    def day_rates(self, year, month, day):
+        """回傳該日 96 個時段的流動電價 (元/kWh)。"""
+        _, day_type_index, season_index = self.day_info(year, month, day)
+        return self.energy_rates[self.rate_index_table[season_index, day_type_index]]
+
+    def period_codes(self, dates):
+        """
+        以陣列方式查出多個日期的時段代碼。
+
+        參數：
+            dates (np.ndarray): datetime64[D] 陣列
+
+        返回：
+            np.ndarray: 形狀為 (len(dates) * 96,) 的時段代碼
+        """
+        _, _, _, day_type_index, season_index = calendar_arrays(dates)
+        return self.period_table[season_index, day_type_index].reshape(-1)
+
+SLOT_INDEX = {slot_time: slot for slot, slot_time in enumerate(SLOT_TIMES)}
+
+def monthly_period_table(monthly_values, default_table=None):
+    """
+    將 {月份: {時段: 數值}} 轉換為 (月份, 時段代碼) 陣列，形狀為 (13, 4)，第 0 列不使用。
+    未提供的月份沿用 default_table。
+    """
+    table = np.zeros((13, len(PERIODS))) if default_table is None else default_table.copy()
+    for month, values in monthly_values.items():
+        table[int(month)] = [values[period] for period in PERIODS]
+    return table
+
+def calendar_arrays(dates):
+    """
+    以陣列方式計算日期的星期、月份、日期、日別索引與季節索引。
+
+    參數：
+        dates (np.ndarray): datetime64[D] 陣列
+
+    返回：
+        tuple: (weekday, month, day, day_type_index, season_index)，皆為整數陣列
+    """
+    weekday = (dates.astype(np.int64) + 3) % 7  # 1970-01-01 為星期四
+    month_start = dates.astype("datetime64[M]")
+    month = month_start.astype(np.int64) % 12 + 1
+    day = (dates - month_start.astype("datetime64[D]")).astype(np.int64) + 1
+    day_type_index = np.clip(weekday - 4, 0, 2)  # 0: Weekday, 1: Saturday, 2: Sunday
+    is_summer = ((month > 5) | ((month == 5) & (day >= 16))) & ((month < 10) | ((month == 10) & (day <= 15)))  # 同 is_summer_day
+    season_index = np.where(is_summer, 0, 1)
+    return weekday, month, day, day_type_index, season_index
+
+def demand_bounds(max_limits, peak_caps, low_mask):
+    """
+    generate_random_demand 的向量化版本：計算每個時段隨機需量的上下限。
+
+    參數：
+        max_limits (np.ndarray): 各時段的最高需量限制 (kW)
+        peak_caps (np.ndarray): 各時段所屬日期的高峰值 (kW)
+        low_mask (np.ndarray): 是否為低需求時段
+
+    返回：
+        tuple: (lower_bound, upper_bound) 陣列
+    """
+    config = get_config()
+    cap = np.minimum(peak_caps, max_limits)
+    upper_bound = np.minimum(np.where(low_mask, config.low_demand_range[1], config.base_demand_range[1]), cap)
+    lower_bound = np.minimum(np.where(low_mask, config.low_demand_range[0], config.base_demand_range[0]), cap)
+    # 確保下限不超過上限
+    lower_bound = np.minimum(lower_bound, upper_bound)
+    return lower_bound, upper_bound
+
+def generate_demand_arrays(start_date, end_date, peak_values=None, default_peak_value=None, rng=None):
+    """
+    以陣列方式一次生成整段期間（一個月或一整年）的需量數據。
+    時段代碼由電價表 (TariffSchedule) 查表取得，所有需量以單次有界均勻抽樣產生，再平滑並釘選峰值。
+
+    參數：
+        start_date (date): 起始日期（含）
+        end_date (date): 結束日期（含）
+        peak_values (dict): 每日峰值，例如 {"2024-04-01 22:30": 25190, ...}，該日以此作為需量上限並釘選
+        default_peak_value (float): 沒有指定峰值的日期所使用的上限，None 時為 BASE_DEMAND_RANGE[0] * 1.5
+        rng (np.random.Generator): 隨機數產生器，None 時使用模組預設產生器
+
+    返回：
+        dict: 欄位陣列 {"date", "weekday", "slot", "period", "demand_kW"}，每列代表一個 15 分鐘時段
+    """
+    columns = generate_fleet_arrays(
+        start_date,
+        end_date,
+        get_config().max_demand_limits_table[None],
+        [peak_values or {}],
+        default_peak_value=default_peak_value,
+        rng=[rng] if isinstance(rng, np.random.Generator) else rng
+    )
+    columns["demand_kW"] = columns["demand_kW"][0]
+    return columns
+
+@traced("generate_fleet_arrays")
+def generate_fleet_arrays(start_date, end_date, max_demand_limits_tables, peak_values_list, default_peak_value=None, rng=None):
+    """
+    一次生成多個電表整段期間的需量數據，各電表參數以廣播方式套用，不逐一電表迴圈生成。
+
+    參數：
+        start_date (date): 起始日期（含）
+        end_date (date): 結束日期（含）
+        max_demand_limits_tables (np.ndarray): 各電表的 (月份, 時段代碼) 最高需量限制，形狀為 (電表數, 13, 4)
+        peak_values_list (list): 各電表的每日峰值 dict
+        default_peak_value (float): 沒有指定峰值的日期所使用的上限，None 時為 BASE_DEMAND_RANGE[0] * 1.5
+        rng (np.random.Generator 或 list): 隨機數產生器；傳入與電表數相同長度的 list 時，
+            每個電表使用自己的隨機數流，結果與同批的其他電表無關。None 時使用模組預設產生器
+
+    返回：
+        dict: 欄位陣列，"demand_kW" 形狀為 (電表數, 時段數)，其餘欄位為各電表共用的一維陣列
+    """
+    config = get_config()
+    rng = _rng if rng is None else rng
+    if default_peak_value is None:
+        default_peak_value = config.base_demand_range[0] * 1.5
+
+    columns, dates, months = calendar_columns(start_date, end_date)
+    demand = sample_demand_arrays(columns, dates, months, max_demand_limits_tables, peak_values_list, default_peak_value, rng)
+
+    # 平滑處理
+    moving_average_array(demand, window_size=SMOOTHING_WINDOW, out=demand)
+
+    columns["demand_kW"] = demand
+    for meter_index, peak_values in enumerate(peak_values_list):
+        pin_peak_values_array(columns, peak_values, demand=demand[meter_index])
+    trace_count(rows=demand.size)
+    return columns
+
+def sample_demand_arrays(columns, dates, months, max_demand_limits_tables, peak_values_list, default_peak_value, rng):
+    """
+    依時段上下限抽樣未平滑的需量（四捨五入到 0.01 kW），形狀為 (電表數, 時段數)。
+    rng 為 list 時每個電表依序從自己的產生器抽樣，分段呼叫的結果與一次抽完整段相同。
+    """
+    config = get_config()
+    period = columns["period"]
+
+    # 當日峰值上限
+    peak_caps = np.full((len(peak_values_list), len(dates)), float(default_peak_value))
+    for meter_index, peak_values in enumerate(peak_values_list):
+        for time_str, value in peak_values.items():
+            offset = (np.datetime64(time_str.split(" ")[0], "D") - dates[0]).astype(np.int64) if len(dates) else -1
+            if 0 <= offset < len(dates):
+                peak_caps[meter_index, offset] = value
+
+    max_limits = max_demand_limits_tables[:, np.repeat(months, SLOTS_PER_DAY), period]
+    low_mask = np.tile(config.low_demand_mask, len(dates))
+
+    lower_bound, upper_bound = demand_bounds(max_limits, np.repeat(peak_caps, SLOTS_PER_DAY, axis=1), low_mask)
+    if isinstance(rng, list):
+        demand = np.empty(lower_bound.shape)
+        for meter_index, meter_rng in enumerate(rng):
+            demand[meter_index] = meter_rng.uniform(lower_bound[meter_index], upper_bound[meter_index])
+    else:
+        demand = rng.uniform(lower_bound, upper_bound)
+    np.round(demand, 2, out=demand)
+    return demand
+
+def month_days(year, month):
+    """該月的實際天數，二月依閏年為 28 或 29 天（設定檔的 MONTHS 固定二月為 28 天，不用於日期計算）。"""
+    return calendar.monthrange(year, month)[1]
+
+def calendar_columns(start_date, end_date):
+    """
+    建立期間內與需量無關的欄位陣列 {"date", "weekday", "slot", "period"}。
+
+    返回：
+        tuple: (dict: 欄位陣列, np.ndarray: 每日日期, np.ndarray: 每日月份)
+    """
+    config = get_config()
+    dates = np.arange(np.datetime64(start_date, "D"), np.datetime64(end_date, "D") + 1)
+    weekday, months, _, day_type_index, season_index = calendar_arrays(dates)
+    columns = {
+        "date": np.repeat(dates, SLOTS_PER_DAY),
+        "weekday": np.repeat(weekday, SLOTS_PER_DAY).astype(np.int8),
+        "slot": np.tile(np.arange(SLOTS_PER_DAY, dtype=np.int16), len(dates)),
+        "period": config.tariff_schedule.period_table[season_index, day_type_index].reshape(-1)
+    }
+    return columns, dates, months
+
+@traced("pin_peak_values_array")
+def pin_peak_values_array(columns, peak_values, demand=None):
+    """
+    依日期與 15 分鐘時段直接計算列索引，一次釘選所有峰值，成本為 O(峰值數)。
+    columns 必須是自第一天 00:00 起每天 96 筆的連續欄位陣列。
+    demand 可指定要釘選的一維需量陣列（例如多電表數據中的一列），None 時使用 columns["demand_kW"]。
+
+    返回：
+        list: 數據中不存在的峰值時間點
+    """
+    demand = columns["demand_kW"] if demand is None else demand
+    start = columns["date"][0] if len(demand) else None
+    missing = []
+    for time_str, peak_value in peak_values.items():
+        peak_date, peak_time = time_str.split(" ")
+        slot = SLOT_INDEX.get(peak_time)
+        index = -1
+        if start is not None and slot is not None:
+            index = int((np.datetime64(peak_date, "D") - start).astype(np.int64)) * SLOTS_PER_DAY + slot
+        if 0 <= index < len(demand):
+            demand[index] = round(float(peak_value), 2)
+        else:
+            missing.append(time_str)
+    report_missing_peak_values(missing)
+    trace_count(rows=len(peak_values))
+    return missing
+
+def report_missing_peak_values(missing):
+    if missing:
+        print(f"警告：找不到 {len(missing)} 個峰值時間點，未套用：{', '.join(missing)}")
+
+def demand_arrays_to_records(columns, meter_no=None):
+    """
+    將欄位陣列轉換為原本的 list-of-dicts 格式。
+
+    參數：
+        columns (dict): generate_demand_arrays 回傳的欄位陣列
+        meter_no (str): 電表編號，None 時使用 METER_NO
+
+    返回：
+        list: 每個元素為包含 meter_no/date/weekday/time/demand_kW/period 的字典
+    """
+    config = get_config()
+    meter_no = config.meter_no if meter_no is None else meter_no
+    date_strings = np.datetime_as_string(columns["date"], unit="D").tolist()
+    return [
+        {
+            "meter_no": meter_no,
+            "date": record_date,
+            "weekday": weekday,
+            "time": SLOT_TIMES[slot],
+            "demand_kW": demand,
+            "period": PERIODS[period]
+        }
+        for record_date, weekday, slot, demand, period in zip(
+            date_strings,
+            columns["weekday"].tolist(),
+            columns["slot"].tolist(),
+            columns["demand_kW"].tolist(),
+            columns["period"].tolist()
+        )
+    ]
+
 def compare_energy_with_reference(stats, reference_totals, year, month):
     """
     比較整個月的總用電度數（kWh）與參考值，計算超出或不足的量，並顯示百分比。
@@ -178,10 +903,13 @@ def compare_energy_with_reference(stats, reference_totals, year, month):
     return differences
 
 
-def generate_daily_demand_data(year=2024, month=4, start_day=1, end_day=None, peak_time=None, peak_value=None):
+@traced("generate_daily_demand_data")
+def generate_daily_demand_data(year=2024, month=4, start_day=1, end_day=None, peak_time=None, peak_value=None, peak_values=None,
+                               rng=None):
     """
-    生成指定日期範圍的需量數據，允許設定特定時間的峰值需量，並計算各時段的最大需量和總需量（kW 和 kWh）。
-    確保隨機生成的需求量不超過當日的 peak_value。同時與參考用電度數比較，調整數據以匹配參考值。
+    生成指定日期範圍的需量數據，允許設定特定時間的峰值需量。
+    確保隨機生成的需求量不超過當日的 peak_value。
+    此函式是 generate_demand_arrays 的相容介面，回傳原本的 list-of-dicts 格式。
 
     參數：
         year (int): 年份，預設 2024
@@ -190,28 +918,14 @@ def generate_daily_demand_data(year=2024, month=4, start_day=1, end_day=None, pe
         end_day (int): 結束日期，若為 None 則預設為該月最後一天
         peak_time (str): 指定的高峰時間，例如 "12:30"
         peak_value (float): 指定的高峰發電量 (kW)
+        peak_values (dict): 整月的每日峰值，例如 {"2024-04-01 22:30": 25190, ...}；
+            若有提供，每一天以當日峰值作為上限，並一次釘選所有峰值（忽略 peak_time/peak_value）
+        rng (np.random.Generator): 隨機數產生器，None 時使用模組預設產生器
 
     返回：
-        tuple: (list: 調整後的需量數據, dict: 調整後的各時段最大需量和總需量/總能量)
+        list: 需量數據，每個元素為包含 meter_no/date/weekday/time/demand_kW/period 的字典
     """
-    # Initialize totals and maximums
-    max_demand_limits = MAX_DEMAND_LIMITS_DICT[month]
-    total_peak_demand = 0
-    total_off_peak_demand = 0
-    total_half_peak_demand = 0
-    total_saturday_half_peak_demand = 0
-
-    total_peak_energy = 0
-    total_off_peak_energy = 0
-    total_half_peak_energy = 0
-    total_saturday_half_peak_energy = 0
-
-    max_peak_demand = 0
-    max_off_peak_demand = 0
-    max_half_peak_demand = 0
-    max_saturday_half_peak_demand = 0
-    
-    days = MONTHS.get(month, 31)
+    days = month_days(year, month)
 
     if end_day is None:
         end_day = days
@@ -219,95 +933,20 @@ def generate_daily_demand_data(year=2024, month=4, start_day=1, end_day=None, pe
     start_day = max(1, start_day)
     end_day = min(days, end_day)
 
-    data = []
-
-    for day in range(start_day, end_day + 1):
-        record_date = datetime(year, month, day)
-        weekday = record_date.weekday()
-        day_type = classify_day_of_week(year, month, day)
-        is_summer = (month > 5 or (month == 5 and day >= 16)) and (month < 10 or (month == 10 and day <= 15))
-        season = "Summer" if is_summer else "Non_Summer"
-
-        for hour in range(24):
-            for minute in [0, 15, 30, 45]:
-                record_time = f"{hour:02d}:{minute:02d}"
-                time_minutes = time_to_minutes(record_time)
-                is_low_demand = LOW_DEMAND_START <= record_time <= LOW_DEMAND_END
-
-                # 時段分類
-                if day_type == "Weekday":
-                    if season == "Summer":
-                        if 16 * 60 <= time_minutes < 22 * 60:  # 16:00-22:00
-                            period = "Peak"
-                        elif (9 * 60 <= time_minutes < 16 * 60) or (22 * 60 <= time_minutes < 24 * 60):  # 09:00-16:00, 22:00-24:00
-                            period = "Half_Peak"
-                        else:  # 00:00-09:00
-                            period = "Off_Peak"
-                    else:  # Non-Summer
-                        if (6 * 60 <= time_minutes < 11 * 60) or (14 * 60 <= time_minutes < 24 * 60):  # 06:00-11:00, 14:00-24:00
-                            period = "Half_Peak"
-                        else:  # 00:00-06:00, 11:00-14:00
-                            period = "Off_Peak"
-                elif day_type == "Saturday":
-                    if season == "Summer":
-                        if 9 * 60 <= time_minutes < 24 * 60:  # 09:00-24:00
-                            period = "Saturday_Half_Peak"
-                        else:  # 00:00-09:00
-                            period = "Off_Peak"
-                    else:  # Non-Summer
-                        if (6 * 60 <= time_minutes < 11 * 60) or (14 * 60 <= time_minutes < 24 * 60):  # 06:00-11:00, 14:00-24:00
-                            period = "Saturday_Half_Peak"
-                        else:  # 00:00-06:00, 11:00-14:00
-                            period = "Off_Peak"
-                else:  # Sunday
-                    period = "Off_Peak"
-
-                    # 生成需求數據
-                demand = generate_random_demand(period, max_demand_limits,peak_value, is_low_demand)
-
-                # 計算能量 (kWh)
-                energy_kWh = demand * (15 / 60)  # 15 分鐘 = 0.25 小時
-
-                # 更新統計數據
-                if period == "Peak":
-                    total_peak_demand += demand
-                    total_peak_energy += energy_kWh
-                    max_peak_demand = max(max_peak_demand, demand)
-                elif period == "Half_Peak":
-                    total_half_peak_demand += demand
-                    total_half_peak_energy += energy_kWh
-                    max_half_peak_demand = max(max_half_peak_demand, demand)
-                elif period == "Saturday_Half_Peak":
-                    total_saturday_half_peak_demand += demand
-                    total_saturday_half_peak_energy += energy_kWh
-                    max_saturday_half_peak_demand = max(max_saturday_half_peak_demand, demand)
-                else:  # Off_Peak
-                    total_off_peak_demand += demand
-                    total_off_peak_energy += energy_kWh
-                    max_off_peak_demand = max(max_off_peak_demand, demand)
-
-                entry = {
-                    "meter_no": METER_NO,
-                    "date": record_date.strftime("%Y-%m-%d"),
-                    "weekday": weekday,
-                    "time": record_time,
-                    "demand_kW": demand,
-                    "period": period
-                }
-                data.append(entry)
-
-    # 平滑處理
-    to_do = []
-    for i in data:
-        to_do.append(i["demand_kW"])   
-    smoothed_demand = moving_average(to_do, window_size=5)
-    for i in range(len(data)):
-        data[i]["demand_kW"] = smoothed_demand[i]
-
-    peak_values = {f"{year}-{month:02d}-{start_day:02d} {peak_time}": peak_value}
-    enforce_peak_values(data, peak_values)
-
-    return data
+    if not peak_values:
+        peak_values = {f"{year}-{month:02d}-{start_day:02d} {peak_time}": peak_value} if peak_time else {}
+        default_peak_value = peak_value
+    else:
+        default_peak_value = None
+
+    columns = generate_demand_arrays(
+        date(year, month, start_day),
+        date(year, month, end_day),
+        peak_values=peak_values,
+        default_peak_value=default_peak_value,
+        rng=rng
+    )
+    return demand_arrays_to_records(columns)
 
 def classify_day_of_week(year, month, day):
     """
@@ -321,43 +960,38 @@ def classify_day_of_week(year, month, day):
     Returns:
         str: 'Weekday', 'Saturday', or 'Sunday'
     """
-    record_date = datetime(year, month, day)
-    weekday = record_date.weekday()
-    if weekday < 5:  # Monday (0) to Friday (4)
-        return "Weekday"
-    elif weekday == 5:  # Saturday
-        return "Saturday"
-    else:  # Sunday
-        return "Sunday"
+    return get_config().tariff_schedule.day_type(year, month, day)
 
 def calculate_basic_charge(contract_capacity, year=2024, month=4, day=12):
-    is_summer = (month > 5 or (month == 5 and day >= 16)) and (month < 10 or (month == 10 and day <= 15))
-    season = "Summer" if is_summer else "Non_Summer"
+    config = get_config()
+    season = config.tariff_schedule.season(year, month, day)
     
-    day_type = classify_day_of_week(year, month, day)
+    day_type = config.tariff_schedule.day_type(year, month, day)
     
     if season == "Summer":
         if day_type == "Weekday":
-            rate = BASIC_CHARGE_RATES[season]["Contract"]
+            rate = config.basic_charge_rates[season]["Contract"]
         elif day_type == "Saturday":
-            rate = BASIC_CHARGE_RATES[season]["Sat_Half_Peak"]
+            rate = config.basic_charge_rates[season]["Sat_Half_Peak"]
         else:  # Sunday
-            rate = BASIC_CHARGE_RATES[season]["Off_Peak"]
+            rate = config.basic_charge_rates[season]["Off_Peak"]
     else:
         if day_type == "Weekday":
-            rate = BASIC_CHARGE_RATES[season]["Half_Peak"]
+            rate = config.basic_charge_rates[season]["Half_Peak"]
         elif day_type == "Saturday":
-            rate = BASIC_CHARGE_RATES[season]["Sat_Half_Peak"]
+            rate = config.basic_charge_rates[season]["Sat_Half_Peak"]
         else:  # Sunday
-            rate = BASIC_CHARGE_RATES[season]["Off_Peak"]
+            rate = config.basic_charge_rates[season]["Off_Peak"]
     
     # Note: The /1000 seems incorrect based on the table (rates are per kW, not MW)
     basic_charge = contract_capacity * rate  # Removed /1000
     return round(basic_charge, 2)
 
+@traced("calculate_energy_charge")
 def calculate_energy_charge(data, year, month, day):
     """
     Calculate the energy charge for a day's demand data based on time-of-use rates.
+    Rates come from the configured TariffSchedule, so the period boundaries match the generated data.
     
     Parameters:
         data (list): List of demand data entries
@@ -368,54 +1002,238 @@ def calculate_energy_charge(data, year, month, day):
     Returns:
         float: Total energy charge (NTD)
     """
-    is_summer = (month > 5 or (month == 5 and day >= 16)) and (month < 10 or (month == 10 and day <= 15))
-    season = "Summer" if is_summer else "Non_Summer"
-    
-    day_type = classify_day_of_week(year, month, day)
+    config = get_config()
+    day_rates = config.tariff_schedule.day_rates(year, month, day)
     
     total_energy_charge = 0.0
     
     for entry in data:
-        time_str = entry["time"]
-        hour, minute = map(int, time_str.split(":"))
-        time_minutes = hour * 60 + minute
-        
-        rates = ENERGY_RATES[season][day_type]
-        
-        if day_type == "Weekday":
-            if season == "Summer":
-                if 16 * 60 <= time_minutes < 22 * 60:  # 16:00-22:00
-                    rate = rates["Peak"]
-                elif (6 * 60 <= time_minutes < 11 * 60) or (14 * 60 <= time_minutes < 24 * 60):  # 06:00-11:00, 14:00-24:00
-                    rate = rates["Half_Peak"]
-                else:  # 00:00-09:00, 11:00-14:00
-                    rate = rates["Off_Peak"]
-            else:  # Non-Summer
-                if (6 * 60 <= time_minutes < 11 * 60) or (14 * 60 <= time_minutes < 24 * 60):  # 06:00-11:00, 14:00-24:00
-                    rate = rates["Half_Peak"]
-                else:  # 00:00-09:00, 11:00-14:00
-                    rate = rates["Off_Peak"]
-        elif day_type == "Saturday":
-            if 6 * 60 <= time_minutes < 24 * 60:  # 06:00-24:00
-                rate = rates["Half_Peak"]
-            else:  # 00:00-06:00
-                rate = rates["Off_Peak"]
-        else:  # Sunday
-            rate = rates["Off_Peak"]
+        rate = day_rates[SLOT_INDEX[entry["time"]]]
         
         # Calculate energy (kWh) for this 15-minute interval
-        demand_kW = entry["demand_kW"]
+        demand_kW = float(entry["demand_kW"])
         energy_kWh = demand_kW * (15 / 60)  # 15 minutes = 0.25 hours
         
         # Calculate cost for this interval
         cost = energy_kWh * rate
         total_energy_charge += cost
     
-    return round(total_energy_charge, 2)
+    trace_count(rows=len(data))
+    return round(float(total_energy_charge), 2)
+
+# 基本電費的契約類別（BASIC_CHARGE_RATES 的鍵）
+CONTRACT_CATEGORIES = ("Contract", "Half_Peak", "Sat_Half_Peak", "Off_Peak")
+DEFAULT_CONTRACT_CAPACITIES = {"Contract": 38000, "Half_Peak": 0, "Sat_Half_Peak": 0, "Off_Peak": 0}
 
+@traced("calculate_bills")
+def calculate_bills(columns, contract_capacities=None):
+    """
+    向量化電費計算：以一次電價索引查表與加權加總計算整段期間（一個月到數年）的流動電費，
+    並依契約類別計算基本電費，按計費月份輸出明細。
+
+    參數：
+        columns (dict): 欄位陣列，需包含 "date"、"slot"、"period" 和 "demand_kW"；
+            "demand_kW" 可為 (電表數, 時段數) 的多電表陣列
+        contract_capacities (dict): 各契約類別的契約容量 (kW)，例如 {"Contract": 38000, "Half_Peak": 0, ...}，
+            None 時使用 DEFAULT_CONTRACT_CAPACITIES；跨夏月與非夏月的月份依天數比例計算
+
+    返回：
+        list: 每個計費月份一筆明細 {"month", "energy_kWh", "energy_charges", "energy_charge",
+            "basic_charges", "basic_charge", "total"}；多電表時各金額為長度等於電表數的陣列
+    """
+    config = get_config()
+    contract_capacities = DEFAULT_CONTRACT_CAPACITIES if contract_capacities is None else contract_capacities
+    dates = columns["date"]
+    period = columns["period"].astype(np.int64)
+    demand = np.asarray(columns["demand_kW"], dtype=float)
+    demand_2d = demand.reshape(-1, demand.shape[-1])
+    meter_count = demand_2d.shape[0]
+
+    # 電價索引查表
+    _, _, _, day_type_index, season_index = calendar_arrays(dates)
+    rates = config.tariff_schedule.energy_rates[config.tariff_schedule.rate_index_table[season_index, day_type_index, columns["slot"]]]
+
+    # 依 (計費月份, 時段) 分組加總
+    billing_months, month_index = np.unique(dates.astype("datetime64[M]"), return_inverse=True)
+    group_count = len(billing_months) * len(PERIODS)
+    group = month_index * len(PERIODS) + period
+    index = (group[None, :] + group_count * np.arange(meter_count)[:, None]).ravel()
+    energy_kWh = np.bincount(index, weights=(demand_2d * (15 / 60)).ravel(), minlength=meter_count * group_count)
+    energy_charges = np.bincount(index, weights=(demand_2d * rates * (15 / 60)).ravel(), minlength=meter_count * group_count)
+    energy_kWh = energy_kWh.reshape(meter_count, len(billing_months), len(PERIODS))
+    energy_charges = energy_charges.reshape(meter_count, len(billing_months), len(PERIODS))
+
+    # 每個計費月份的夏月天數比例
+    summer_share = np.bincount(month_index, weights=(season_index == 0)) / np.bincount(month_index)
+    basic_rates = np.array([
+        [config.basic_charge_rates[season][category] for category in CONTRACT_CATEGORIES]
+        for season in SEASONS
+    ])
+    monthly_basic_rates = summer_share[:, None] * basic_rates[0] + (1 - summer_share[:, None]) * basic_rates[1]
+    capacities = np.array([contract_capacities.get(category, 0) for category in CONTRACT_CATEGORIES], dtype=float)
+    basic_charges = monthly_basic_rates * capacities
+
+    def value(array):
+        array = np.round(array, 2)
+        return float(array[0]) if demand.ndim == 1 else array
+
+    bills = []
+    for month_position, billing_month in enumerate(billing_months):
+        energy_charge = energy_charges[:, month_position].sum(axis=1)
+        basic_charge = basic_charges[month_position].sum()
+        bills.append({
+            "month": str(billing_month),
+            "energy_kWh": {name: value(energy_kWh[:, month_position, code]) for code, name in enumerate(PERIODS)},
+            "energy_charges": {name: value(energy_charges[:, month_position, code]) for code, name in enumerate(PERIODS)},
+            "energy_charge": value(energy_charge),
+            "basic_charges": {category: round(float(basic_charges[month_position, position]), 2)
+                              for position, category in enumerate(CONTRACT_CATEGORIES)},
+            "basic_charge": round(float(basic_charge), 2),
+            "total": value(energy_charge + basic_charge)
+        })
+    trace_count(rows=columns["demand_kW"].size)
+    return bills
+
+# 超約附加費：超出契約容量 10% 以內的部分按基本電費費率 2 倍，超過 10% 的部分按 3 倍計收
+CONTRACT_OVERAGE_TIERS = ((0.10, 2.0), (np.inf, 3.0))
+CONTRACT_SWEEP_POINTS = 1000
+
+class ContractCapacityProfile:
+    """
+    契約容量試算：每個資料集只掃描一次，保存各 (電表, 計費月份) 的最高需量與夏月時段數；
+    之後任意候選契約容量的基本電費加超約附加費都以廣播運算一次算出，不需重新計算電費。
+    可逐月 update，不同 worker 的結果以 merge 合併。
+
+    只試算經常契約 (BASIC_CHARGE_RATES 的 "Contract")，超約以當月所有時段的最高需量計算；
+    跨夏月與非夏月的月份費率依時段數比例計算，與 calculate_bills 相同。
+    """
+    __slots__ = ("months", "meter_count")
+
+    def __init__(self):
+        self.months = {}  # "YYYY-MM" → [最高需量 (電表數,), 夏月時段數, 時段數]
+        self.meter_count = None
+
+    @classmethod
+    def from_columns(cls, columns):
+        return cls().update(columns)
+
+    def update(self, columns):
+        """
+        累加欄位陣列（可跨月份或只是一個月的一部分），"demand_kW" 可為一維或 (電表數, 時段數)，返回 self。
+        """
+        demand = np.asarray(columns["demand_kW"], dtype=float)
+        demand = demand.reshape(-1, demand.shape[-1])
+        if self.meter_count is None:
+            self.meter_count = demand.shape[0]
+        elif demand.shape[0] != self.meter_count:
+            raise ValueError(f"電表數 {demand.shape[0]} 與先前的 {self.meter_count} 不同")
+        dates = columns["date"]
+        if not len(dates):
+            return self
+
+        season_index = calendar_arrays(dates)[4]
+        billing_months, month_index = np.unique(dates.astype("datetime64[M]"), return_inverse=True)
+        order = np.argsort(month_index, kind="stable")
+        starts = np.searchsorted(month_index[order], np.arange(len(billing_months)))
+        maxima = np.maximum.reduceat(demand[:, order], starts, axis=1)
+        summer_slots = np.bincount(month_index, weights=season_index == 0, minlength=len(billing_months))
+        slots = np.bincount(month_index, minlength=len(billing_months))
+        for position, billing_month in enumerate(billing_months):
+            self.add_month(str(billing_month), maxima[:, position], summer_slots[position], slots[position])
+        trace_count("contract_profile", rows=demand.size)
+        return self
+
+    def add_month(self, billing_month, maxima, summer_slots, slots):
+        entry = self.months.get(billing_month)
+        if entry is None:
+            self.months[billing_month] = [np.array(maxima, dtype=float), float(summer_slots), int(slots)]
+        else:
+            np.maximum(entry[0], maxima, out=entry[0])
+            entry[1] += summer_slots
+            entry[2] += slots
+
+    def merge(self, other):
+        """合併另一個 ContractCapacityProfile（例如另一個 worker 的月份），返回 self。"""
+        if other.meter_count is not None and self.meter_count is not None and other.meter_count != self.meter_count:
+            raise ValueError(f"電表數 {other.meter_count} 與 {self.meter_count} 不同")
+        self.meter_count = self.meter_count if self.meter_count is not None else other.meter_count
+        for billing_month, (maxima, summer_slots, slots) in other.months.items():
+            self.add_month(billing_month, maxima, summer_slots, slots)
+        return self
+
+    def arrays(self):
+        """返回 (各月最高需量 (電表數, 月數), 各月經常契約基本電費費率 (月數,))。"""
+        config = get_config()
+        entries = [self.months[billing_month] for billing_month in sorted(self.months)]
+        maxima = np.stack([entry[0] for entry in entries], axis=1)
+        summer_share = np.array([entry[1] / entry[2] for entry in entries])
+        rates = (summer_share * config.basic_charge_rates["Summer"]["Contract"]
+                 + (1 - summer_share) * config.basic_charge_rates["Non_Summer"]["Contract"])
+        return maxima, rates
+
+    def costs(self, capacities):
+        """
+        計算候選契約容量的基本電費加超約附加費（整段期間合計）。
+
+        參數：
+            capacities (array-like): 候選契約容量 (kW)，形狀為 (候選數,)，或各電表各自的 (電表數, 候選數)
+
+        返回：
+            np.ndarray: 形狀為 (電表數, 候選數)
+        """
+        maxima, rates = self.arrays()
+        capacities = np.atleast_2d(np.asarray(capacities, dtype=float))[:, None, :]  # (1 或電表數, 1, 候選數)
+        excess = np.maximum(maxima[:, :, None] - capacities, 0)  # (電表數, 月數, 候選數)
+        charged = capacities + np.zeros(excess.shape)
+        lower = 0.0
+        for share, multiplier in CONTRACT_OVERAGE_TIERS:
+            upper = capacities * share if np.isfinite(share) else np.inf
+            charged += multiplier * np.clip(excess - lower, 0, upper - lower)
+            lower = upper
+        return np.einsum("mkc,k->mc", charged, rates)
+
+    def optimum(self):
+        """
+        每個電表成本最低的契約容量。各月成本是契約容量的凸分段線性函數，轉折點為當月最高需量與各級超約門檻，
+        最佳值必在轉折點上，只評估這些點即為精確解。
+
+        返回：
+            tuple: (np.ndarray: 最佳契約容量 (電表數,), np.ndarray: 最低成本 (電表數,))
+        """
+        maxima, _ = self.arrays()
+        shares = [0.0] + [share for share, _ in CONTRACT_OVERAGE_TIERS if np.isfinite(share)]
+        candidates = np.concatenate([maxima / (1 + share) for share in shares], axis=1)  # (電表數, 轉折點數)
+        costs = self.costs(candidates)
+        best = np.argmin(costs, axis=1)
+        rows = np.arange(len(best))
+        return candidates[rows, best], costs[rows, best]
+
+    def sweep(self, capacities=None, points=CONTRACT_SWEEP_POINTS):
+        """
+        計算成本曲線與最佳契約容量。
+
+        參數：
+            capacities (array-like): 候選契約容量，None 時為 0 到最高需量 1.2 倍之間的 points 個等距點
+            points (int): 預設候選點數
+
+        返回：
+            dict: {"capacities", "costs" (電表數, 候選數), "optimal_capacity" (電表數,), "optimal_cost" (電表數,)}
+        """
+        if capacities is None:
+            capacities = np.linspace(0, self.arrays()[0].max() * 1.2, points)
+        capacities = np.asarray(capacities, dtype=float)
+        optimal_capacity, optimal_cost = self.optimum()
+        return {
+            "capacities": capacities,
+            "costs": self.costs(capacities),
+            "optimal_capacity": optimal_capacity,
+            "optimal_cost": optimal_cost
+        }
+
+@traced("plot_demand_data")
 def plot_demand_data(filename, year=2024, month=4):
     """
-    從 CSV 檔案讀取需量數據，並為每一天繪製圖表，時段背景顏色與需求曲線對齊。
+    從 CSV 檔案串流讀取指定年月的需量數據，並為每一天繪製圖表，時段背景顏色與需求曲線對齊。
 
     參數：
         filename (str): CSV 檔案路徑，例如 "factory_demand_data2024_7.csv"
@@ -424,145 +1242,366 @@ def plot_demand_data(filename, year=2024, month=4):
     """
     # 1. 從 CSV 檔案讀取數據
     try:
-        with open(filename, "r", encoding="utf-8") as file:
-            reader = csv.DictReader(file)
-            data = []
-            for row in reader:
-                # 確保 demand_kW 是浮點數
-                row["demand_kW"] = float(row["demand_kW"])
-                data.append(row)
+        chunks = list(read_csv_chunks(filename, year=year, month=month))
     except FileNotFoundError:
         print(f"錯誤：找不到檔案 {filename}")
         return
     except Exception as e:
         print(f"讀取檔案時發生錯誤：{e}")
         return
+    if not chunks:
+        return
 
     # 2. 按日期分組數據
-    daily_data = {}
-    for entry in data:
-        date = entry["date"]
-        if date not in daily_data:
-            daily_data[date] = []
-        daily_data[date].append(entry)
+    dates = np.concatenate([chunk["date"] for chunk in chunks])
+    slots = np.concatenate([chunk["slot"] for chunk in chunks])
+    demand = np.concatenate([chunk["demand_kW"] for chunk in chunks])
+    order = np.argsort(dates, kind="stable")
+    day_values, day_starts, day_counts = np.unique(dates[order], return_index=True, return_counts=True)
 
     # 檢查每一天的數據點數量
-    for date, entries in daily_data.items():
-        if len(entries) != 96:  # 每一天應有 96 個數據點（24 小時 × 4）
-            print(f"警告：{date} 的數據點數量為 {len(entries)}，預期為 96，可能數據不完整！")
+    for day, count in zip(day_values, day_counts):
+        if count != 96:  # 每一天應有 96 個數據點（24 小時 × 4）
+            print(f"警告：{day} 的數據點數量為 {count}，預期為 96，可能數據不完整！")
 
     # 3. 為每一天繪製圖表
-    for date, entries in daily_data.items():
-        # 提取該天的時間和需量數據
-        times = [entry["time"] for entry in entries]
-        demands = [entry["demand_kW"] for entry in entries]
-        periods = [entry["period"] for entry in entries]  # 提取時段分類
-
-        # 創建 x 軸數據點
-        x = range(len(demands))  # 0 到 95，對應 96 個數據點
-
-        # 繪製折線圖
-        fig, ax = plt.subplots(figsize=(12, 6))
-
-        # 追蹤每個時段是否已添加過圖例標籤
-        labeled_periods = {
-            "Peak": False,
-            "Half_Peak": False,
-            "Saturday_Half_Peak": False,
-            "Off_Peak": False
-        }
+    for day, start, count in zip(day_values, day_starts, day_counts):
+        rows = order[start:start + count]
+        times = [SLOT_TIMES[slot] for slot in slots[rows].tolist()]
+        plot_daily_demand(str(day), times, demand[rows].tolist(), year, month)
+
+@traced("plot_demand_arrays")
+def plot_demand_arrays(columns, year=2024, month=4, workers=1, mode="daily", executor=None):
+    """
+    直接以 generate_demand_arrays 的欄位陣列繪製圖表，不需讀取 CSV。
+
+    參數：
+        columns (dict): 欄位陣列，需包含 "date"、"slot" 和 "demand_kW"
+        year (int): 年份
+        month (int): 月份
+        workers (int): 每日圖表分配到多少個行程繪製，1 表示在目前行程依序繪製
+        mode (str): "daily" 每天一張圖；"monthly" 整月畫成一張小圖矩陣 demand_plot_YYYY_MM.png
+        executor (ProcessPoolExecutor): 沿用的行程池（例如 worker_pool 建立、跨多次呼叫共用），None 時自行建立
+    """
+    dates = columns["date"]
+    if len(dates) == 0:
+        return
+    if mode == "monthly":
+        plot_month_overview(columns, year, month)
+        return
+
+    # 每天 96 筆連續數據，依日期邊界切分
+    boundaries = np.flatnonzero(dates[1:] != dates[:-1]) + 1
+    date_strings = np.datetime_as_string(dates[np.concatenate(([0], boundaries))], unit="D").tolist()
+    days = [
+        (day, [SLOT_TIMES[slot] for slot in slots.tolist()], demands.tolist())
+        for day, slots, demands in zip(
+            date_strings,
+            np.split(columns["slot"], boundaries),
+            np.split(columns["demand_kW"], boundaries)
+        )
+    ]
+
+    if workers > 1:
+        chunks = [days[index::workers] for index in range(workers)]
+        with worker_pool(workers) if executor is None else contextlib.nullcontext(executor) as executor:
+            list(executor.map(render_days, chunks, [year] * workers, [month] * workers))
+    else:
+        render_days(days, year, month)
+
+def render_days(days, year, month):
+    """以同一組 Figure 與圖形元件依序繪製多天的圖表，可在 worker 行程中執行。"""
+    renderer = get_day_renderer()
+    for day, times, demands in days:
+        renderer.render(day, times, demands, year, month)
+    flush_trace()
+    return len(days)
+
+def plot_daily_demand(date, times, demands, year, month):
+    """
+    繪製單日需量圖表並存成 demand_plot_YYYY_MM_DD.png，時段背景顏色與需求曲線對齊。
 
-        # 定義時段顏色對應
-        period_color_mapping = {
-            "Peak": "red",
-            "Half_Peak": "orange",
-            "Saturday_Half_Peak": "blue",
-            "Off_Peak": "green"
+    參數：
+        date (str): 日期，例如 "2024-07-01"
+        times (list): 時間字串，例如 ["00:00", "00:15", ...]
+        demands (list): 對應的需量 (kW)
+        year (int): 年份
+        month (int): 月份
+    """
+    get_day_renderer().render(date, times, demands, year, month)
+
+# 時段顏色與圖例名稱
+PERIOD_COLORS = {
+    "Peak": "red",
+    "Half_Peak": "orange",
+    "Saturday_Half_Peak": "blue",
+    "Off_Peak": "green"
+}
+PERIOD_LABELS = {
+    "Peak": "尖峰",
+    "Half_Peak": "半尖峰",
+    "Saturday_Half_Peak": "週六半尖峰",
+    "Off_Peak": "離峰"
+}
+PLOT_CONTRACT_CAPACITY = DEFAULT_CONTRACT_CAPACITIES["Contract"]  # 圖表上的契約電力紅線 (kW)
+
+def period_fill_masks(period_codes):
+    """
+    回傳各時段的填色遮罩，每段延伸到下一段的第一個點，讓相鄰時段的背景連續。
+    """
+    masks = {}
+    for code in np.unique(period_codes).tolist():
+        mask = period_codes == code
+        extended = mask.copy()
+        extended[1:] |= mask[:-1]
+        masks[code] = extended
+    return masks
+
+_matplotlib = None
+
+def load_matplotlib():
+    """
+    第一次繪圖時才匯入 matplotlib 並設定中文字體，只需要 CSV 與電費結果的工作不必負擔匯入時間。
+
+    返回：
+        types.SimpleNamespace: Figure, FigureCanvasAgg, Patch
+    """
+    global _matplotlib
+    if _matplotlib is None:
+        import matplotlib
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+        from matplotlib.patches import Patch
+
+        # 設置中文字體
+        matplotlib.rcParams['font.sans-serif'] = ['Noto Sans CJK JP', 'Noto Serif CJK JP', 'DejaVu Sans']  # 按優先順序嘗試
+        matplotlib.rcParams['axes.unicode_minus'] = False  # 解決負號顯示問題
+        _matplotlib = types.SimpleNamespace(Figure=Figure, FigureCanvasAgg=FigureCanvasAgg, Patch=Patch)
+    return _matplotlib
+
+class DemandDayRenderer:
+    """
+    重複使用同一個 Figure 與圖形元件繪製每日需量圖，每天只更新曲線、背景填色與標註。
+    使用 Agg 畫布，不經過 pyplot，可安全地在 worker 行程中使用。
+    """
+
+    def __init__(self):
+        mpl = load_matplotlib()
+        self.figure = mpl.Figure(figsize=(12, 6))
+        mpl.FigureCanvasAgg(self.figure)
+        ax = self.ax = self.figure.subplots()
+
+        x = np.arange(SLOTS_PER_DAY)
+        self.line, = ax.plot(x, np.zeros(SLOTS_PER_DAY), color='blue', label="需量 (kW)")
+        self.max_marker, = ax.plot([0], [0], "b^")
+        self.max_text = ax.text(0, 0, "", fontsize=9, ha="right", va="bottom")
+        self.fills = []
+        self.period_handles = {
+            period: mpl.Patch(color=PERIOD_COLORS[period], alpha=0.3, label=PERIOD_LABELS[period])
+            for period in PERIODS
         }
 
-        # 動態填充時段背景，確保連續性
-        current_period = periods[0]
-        start_idx = 0
-
-        for i in range(1, len(periods)):
-            if periods[i] != current_period or i == len(periods) - 1:
-                end_idx = i + 1 if i != len(periods) - 1 else i + 1
-                color = period_color_mapping.get(current_period, "white")
-                label = None
-
-                # 設置圖例標籤
-                if not labeled_periods[current_period]:
-                    label = {
-                        "Peak": "尖峰",
-                        "Half_Peak": "半尖峰",
-                        "Saturday_Half_Peak": "週六半尖峰",
-                        "Off_Peak": "離峰"
-                    }.get(current_period, "")
-                    labeled_periods[current_period] = True
-
-                ax.fill_between(x[start_idx:end_idx], 0, demands[start_idx:end_idx],
-                                color=color, alpha=0.3, label=label)
-
-                # 更新起始點和當前時段
-                start_idx = i
-                current_period = periods[i]
-
-        # 確保最後一段填充完整 (最右邊)
-        ax.fill_between(x[start_idx:len(x)], 0, demands[start_idx:len(x)],
-                        color=period_color_mapping.get(current_period, 'white'), alpha=0.3)
-
-        # 繪製需求曲線
-        ax.plot(x, demands, color='blue', label="需量 (kW)")
-
-        # 標註最高需量點
-        max_demand = max(demands)
-        max_index = demands.index(max_demand)
-        ax.plot(max_index, max_demand, "b^", label=f"最高需量: {max_demand:.0f} kW")
-        ax.text(max_index, max_demand, f"{max_demand:.0f} kW", fontsize=9, ha="right", va="bottom")
-
-        # 設置圖表標題和標籤
-        day = int(date.split("-")[-1])
-        ax.set_title(f"{year} - 年 {month} - 月 {day} - 日")
+        ax.set_title(" ")
         ax.set_xlabel("時間 (15 分鐘)")
         ax.set_ylabel("需量 (kW)")
-
-        # 設置 X 軸刻度（從 00:00 到 23:45，顯示每小時）
-        ax.set_xticks(range(0, len(times), 4))
-        ax.set_xticklabels(times[::4], rotation=45)
-        # 設置 X 軸範圍
-        ax.set_xlim([0, 95])
-        ax.margins(x=0)  # 消除左右邊距
-
-        # 設置 Y 軸刻度範圍
         ax.set_ylim(0, 40000)
         ax.set_yticks(range(0, 45000, 10000))
+        ax.margins(x=0)  # 消除左右邊距
 
         # 添加契約容量紅線
-        contract_capacity = 38000
-        ax.axhline(y=contract_capacity, color='red', linestyle='--', label=f"契約電力: {contract_capacity} kW")
+        contract_capacity = PLOT_CONTRACT_CAPACITY
+        self.contract_line = ax.axhline(y=contract_capacity, color='red', linestyle='--', label=f"契約電力: {contract_capacity} kW")
         ax.text(90, contract_capacity + 500, f"契約電力 {contract_capacity} kW", color='red', ha="right")
-
-        # 添加圖例
-        ax.legend(loc='upper right')
-
-        # 添加網格
         ax.grid(True)
 
-        # 調整布局
-        plt.tight_layout()
+        self._set_times(SLOT_TIMES)
+        self.figure.tight_layout()
+
+    def _set_times(self, times):
+        # 設置 X 軸刻度（從 00:00 到 23:45，顯示每小時）
+        self.times = list(times)
+        self.ax.set_xticks(range(0, len(times), 4))
+        self.ax.set_xticklabels(times[::4], rotation=45)
+        # 設置 X 軸範圍
+        self.ax.set_xlim([0, 95])
+
+    @traced("render_day")
+    def render(self, date, times, demands, year, month):
+        """
+        繪製一天的圖表並存檔。
+
+        參數：
+            date (str): 日期，例如 "2024-07-01"
+            times (list): 時間字串
+            demands (list): 對應的需量 (kW)
+            year (int): 年份
+            month (int): 月份
+        """
+        config = get_config()
+        ax = self.ax
+        demands = np.asarray(demands, dtype=float)
+        x = np.arange(len(demands))
+
+        # 時段分類由電價表查出，不再依賴 CSV 中的 period 字串
+        record_year, record_month, record_day = map(int, date.split("-"))
+        day_periods = config.tariff_schedule.day_periods(record_year, record_month, record_day)
+        period_codes = day_periods[[SLOT_INDEX[time] for time in times]]
+
+        if list(times) != self.times:
+            self._set_times(times)
+
+        # 每個時段只用一個 fill_between，依出現順序建立圖例
+        for fill in self.fills:
+            fill.remove()
+        self.fills = []
+        for code, mask in period_fill_masks(period_codes).items():
+            period = PERIODS[code]
+            self.fills.append(ax.fill_between(x, 0, demands, where=mask, color=PERIOD_COLORS[period], alpha=0.3))
+        _, first_index = np.unique(period_codes, return_index=True)
+        ordered_codes = period_codes[np.sort(first_index)].tolist()
+
+        # 更新需求曲線與最高需量點
+        self.line.set_data(x, demands)
+        max_index = int(np.argmax(demands))
+        max_demand = demands[max_index]
+        self.max_marker.set_data([max_index], [max_demand])
+        self.max_marker.set_label(f"最高需量: {max_demand:.0f} kW")
+        self.max_text.set_position((max_index, max_demand))
+        self.max_text.set_text(f"{max_demand:.0f} kW")
+
+        ax.set_title(f"{year} - 年 {month} - 月 {record_day} - 日")
+        handles = [self.period_handles[PERIODS[code]] for code in ordered_codes]
+        ax.legend(handles=handles + [self.line, self.max_marker, self.contract_line], loc='upper right')
 
         # 保存圖表
-        plt.savefig(f"demand_plot_{year}_{month:02d}_{day:02d}.png")
-        plt.close()
+        self.figure.savefig(f"demand_plot_{year}_{month:02d}_{record_day:02d}.png")
+        trace_count(rows=len(demands), figures=1)
+
+_day_renderer = None
+
+def get_day_renderer():
+    """每個行程只建立一次 DemandDayRenderer。"""
+    global _day_renderer
+    if _day_renderer is None:
+        _day_renderer = DemandDayRenderer()
+    return _day_renderer
+
+@traced("plot_month_overview")
+def plot_month_overview(columns, year, month):
+    """
+    將整月每天的需量曲線畫成一張小圖矩陣（每列 7 天），存成 demand_plot_YYYY_MM.png，取代逐日的圖檔。
+
+    參數：
+        columns (dict): 單一月份的欄位陣列
+        year (int): 年份
+        month (int): 月份
+    """
+    demand = columns["demand_kW"].reshape(-1, SLOTS_PER_DAY)
+    period = columns["period"].reshape(-1, SLOTS_PER_DAY)
+    day_count = demand.shape[0]
+    rows = (day_count + 6) // 7
+
+    mpl = load_matplotlib()
+    figure = mpl.Figure(figsize=(21, 3 * rows))
+    mpl.FigureCanvasAgg(figure)
+    axes = figure.subplots(rows, 7, sharex=True, sharey=True, squeeze=False).ravel()
+    x = np.arange(SLOTS_PER_DAY)
+    for day_index, ax in enumerate(axes):
+        if day_index >= day_count:
+            ax.set_visible(False)
+            continue
+        for code, mask in period_fill_masks(period[day_index]).items():
+            ax.fill_between(x, 0, demand[day_index], where=mask, color=PERIOD_COLORS[PERIODS[code]], alpha=0.3)
+        ax.plot(x, demand[day_index], color='blue', linewidth=0.8)
+        ax.axhline(y=PLOT_CONTRACT_CAPACITY, color='red', linestyle='--', linewidth=0.8)
+        ax.set_title(f"{month} 月 {day_index + 1} 日", fontsize=9)
+        ax.set_xlim([0, 95])
+        ax.set_ylim(0, 40000)
+        ax.set_xticks(range(0, SLOTS_PER_DAY, 24))
+        ax.set_xticklabels(SLOT_TIMES[::24])
+        ax.grid(True)
+
+    handles = [mpl.Patch(color=PERIOD_COLORS[period], alpha=0.3, label=PERIOD_LABELS[period]) for period in PERIODS]
+    figure.legend(handles=handles, loc='upper right', ncol=len(PERIODS))
+    figure.suptitle(f"{year} - 年 {month} - 月 需量 (kW)")
+    figure.tight_layout(rect=(0, 0, 1, 0.97))
+    figure.savefig(f"demand_plot_{year}_{month:02d}.png")
+    trace_count(rows=len(columns["demand_kW"]), figures=1)
 
 def moving_average(data, window_size=3):
-    smoothed_data = []
-    for i in range(len(data)):
-        start = max(0, i - window_size // 2)
-        end = min(len(data), i + window_size // 2 + 1)
-        smoothed_value = sum(data[start:end]) / (end - start)
-        smoothed_data.append(round(smoothed_value, 2))  # 保留 2 位小數
-    return smoothed_data
+    smoothed_data = moving_average_array(np.asarray(data, dtype=float), window_size)
+    return smoothed_data.tolist()
+
+@traced("moving_average_array")
+def moving_average_array(values, window_size=3, decimals=2, out=None):
+    """
+    以累積和計算移動平均，時間複雜度 O(n)，邊界使用與 moving_average 相同的縮小視窗。
+    支援多維陣列（例如 電表 × 時段），沿最後一個維度平滑。
+
+    參數：
+        values (np.ndarray): 需量數據
+        window_size (int): 視窗大小，偶數時與原本相同視為 window_size + 1
+        decimals (int): 保留小數位數，None 表示不四捨五入
+        out (np.ndarray): 輸出陣列，可傳入 values 本身以原地平滑
+
+    返回：
+        np.ndarray: 平滑後的數據
+    """
+    values = np.asarray(values, dtype=float)
+    half = window_size // 2
+    n = values.shape[-1]
+    cumulative = np.zeros(values.shape[:-1] + (n + 1,))
+    np.cumsum(values, axis=-1, out=cumulative[..., 1:])
+
+    index = np.arange(n)
+    start = np.maximum(index - half, 0)
+    end = np.minimum(index + half + 1, n)
+    out = np.divide(cumulative[..., end] - cumulative[..., start], end - start, out=out)
+    if decimals is not None:
+        np.round(out, decimals, out=out)
+    trace_count(rows=values.size)
+    return out
+
+def moving_average_stream(chunks, window_size=3, decimals=2):
+    """
+    串流版移動平均：逐塊讀入數據並逐塊輸出平滑結果，只保留視窗所需的前後數據。
+    結果與對整段數據呼叫 moving_average 相同（包含頭尾的縮小視窗）。
+
+    參數：
+        chunks (iterable): 依時間順序的數據塊（list 或 np.ndarray）
+        window_size (int): 視窗大小
+        decimals (int): 保留小數位數，None 表示不四捨五入
+
+    產出：
+        np.ndarray: 平滑後的數據塊，總長度與輸入相同（輸出會落後輸入 window_size // 2 筆）
+    """
+    half = window_size // 2
+    left = np.empty(0)      # 已輸出、作為左側視窗的數據
+    pending = np.empty(0)   # 尚未輸出的數據
+
+    def smooth(buffer, first, last):
+        cumulative = np.concatenate(([0.0], np.cumsum(buffer)))
+        index = np.arange(first, last)
+        start = np.maximum(index - half, 0)
+        end = np.minimum(index + half + 1, len(buffer))
+        smoothed = (cumulative[end] - cumulative[start]) / (end - start)
+        return smoothed if decimals is None else np.round(smoothed, decimals)
+
+    for chunk in chunks:
+        buffer = np.concatenate((left, pending, np.asarray(chunk, dtype=float)))
+        first = len(left)
+        last = len(buffer) - half  # 右側視窗完整的數據才輸出
+        if last > first:
+            yield smooth(buffer, first, last)
+            left = buffer[max(last - half, 0):last]
+            pending = buffer[last:]
+        else:
+            pending = buffer[first:]
+
+    # 串流結束：剩餘數據使用縮小的右側視窗
+    if len(pending):
+        buffer = np.concatenate((left, pending))
+        yield smooth(buffer, len(left), len(buffer))
 
 def adjust_demand_to_reference(all_data, differences, max_demand_limits):
     """
@@ -587,7 +1626,8 @@ def adjust_demand_to_reference(all_data, differences, max_demand_limits):
         period = entry["period"]
         period_counts[period] += 1
 
-    # 調整 demand_kW
+    # 調整 demand_kW，同時累加調整後的統計數據
+    stats = PeriodStats()
     for entry in all_data:
         period = entry["period"]
         if period in differences and period_counts[period] > 0:
@@ -601,62 +1641,9 @@ def adjust_demand_to_reference(all_data, differences, max_demand_limits):
             # 確保 demand_kW 在合理範圍內
             max_demand_limit = max_demand_limits[period]
             entry["demand_kW"] = max(0, min(max_demand_limit, round(entry["demand_kW"])))
+        stats.add(PERIOD_CODES[period], entry["demand_kW"])
 
-    # 重新計算 monthly_stats
-    monthly_stats = {
-        "max_peak_demand": 0,
-        "max_off_peak_demand": 0,
-        "max_half_peak_demand": 0,
-        "max_saturday_half_peak_demand": 0,
-        "total_peak_demand": 0,
-        "total_off_peak_demand": 0,
-        "total_half_peak_demand": 0,
-        "total_saturday_half_peak_demand": 0,
-        "total_demand":0,
-        "total_energy": 0,
-        "total_peak_energy": 0,
-        "total_off_peak_energy": 0,
-        "total_half_peak_energy": 0,
-        "total_saturday_half_peak_energy": 0
-    }
-
-    for entry in all_data:
-        demand = entry["demand_kW"]
-        energy_kWh = demand * (15 / 60)  # 15 minutes = 0.25 hours
-        period = entry["period"]
-
-        if period == "Peak":
-            monthly_stats["total_peak_demand"] += demand
-            monthly_stats["total_peak_energy"] += energy_kWh
-            monthly_stats["max_peak_demand"] = max(monthly_stats["max_peak_demand"], demand)
-        elif period == "Half_Peak":
-            monthly_stats["total_half_peak_demand"] += demand
-            monthly_stats["total_half_peak_energy"] += energy_kWh
-            monthly_stats["max_half_peak_demand"] = max(monthly_stats["max_half_peak_demand"], demand)
-        elif period == "Saturday_Half_Peak":
-            monthly_stats["total_saturday_half_peak_demand"] += demand
-            monthly_stats["total_saturday_half_peak_energy"] += energy_kWh
-            monthly_stats["max_saturday_half_peak_demand"] = max(monthly_stats["max_saturday_half_peak_demand"], demand)
-        else:  # Off_Peak
-            monthly_stats["total_off_peak_demand"] += demand
-            monthly_stats["total_off_peak_energy"] += energy_kWh
-            monthly_stats["max_off_peak_demand"] = max(monthly_stats["max_off_peak_demand"], demand)
-
-    # 計算總能量
-    monthly_stats["total_energy"] = (
-        monthly_stats["total_peak_energy"] +
-        monthly_stats["total_half_peak_energy"] +
-        monthly_stats["total_off_peak_energy"] +
-        monthly_stats["total_saturday_half_peak_energy"]
-    )
-    monthly_stats["total_demand"] = (
-        monthly_stats["total_peak_demand"] +
-        monthly_stats["total_half_peak_demand"] +
-        monthly_stats["total_off_peak_demand"] +
-        monthly_stats["total_saturday_half_peak_demand"]
-    )
-
-    return all_data, monthly_stats
+    return all_data, stats.as_dict(decimals=None)
 
 # 1. 讀取 CSV 檔案並統計各時段數據點數量
 def read_and_count_periods(filename):
@@ -703,22 +1690,57 @@ def adjust_demand(all_data, period_counts, differences, max_demand_limits):
 
     return all_data
 # 3. 確保 PEAK_VALUES 的指定值
-def enforce_peak_values(all_data, peak_values):
+def build_row_index(all_data):
+    """
+    建立 (meter_no, date, time) → 列索引，讓峰值釘選與更新不需逐筆掃描。
+    """
+    return {(entry["meter_no"], entry["date"], entry["time"]): row for row, entry in enumerate(all_data)}
+
+@traced("enforce_peak_values")
+def enforce_peak_values(all_data, peak_values, meter_no=None, row_index=None):
+    """
+    將指定時間點的需量設為 PEAK_VALUES 的值。以列索引查找，成本為 O(峰值數)。
+
+    參數：
+        all_data (list): 需量數據
+        peak_values (dict): 峰值，例如 {"2024-07-01 23:45": 30000, ...}
+        meter_no (str): 要釘選的電表，None 時使用第一筆數據的電表
+        row_index (dict): build_row_index 建立的索引，None 時自動建立
+
+    返回：
+        list: 數據中不存在的峰值時間點
+    """
+    if not all_data:
+        missing = list(peak_values)
+        report_missing_peak_values(missing)
+        return missing
+    if meter_no is None:
+        meter_no = all_data[0]["meter_no"]
+    if row_index is None:
+        row_index = build_row_index(all_data)
+
+    missing = []
     for time_str, peak_value in peak_values.items():
         # 解析時間字串，例如 "2024-07-01 23:45"
         date, time = time_str.split(" ")
-        for entry in all_data:
-            if entry["date"] == date and entry["time"] == time:
-                entry["demand_kW"] = round(float(peak_value), 2)
-                break
+        row = row_index.get((meter_no, date, time))
+        if row is None:
+            missing.append(time_str)
+            continue
+        all_data[row]["demand_kW"] = round(float(peak_value), 2)
+
+    report_missing_peak_values(missing)
+    trace_count(rows=len(peak_values))
+    return missing
 
 # 4. 寫回 CSV 檔案
+@traced("write_to_csv")
 def write_to_csv(filename, new_data):
     """
     確保每個時間點的數據只出現一次，若時間點已存在則更新數據。
     """
     file_exists = os.path.exists(filename)
-    fieldnames = ["meter_no", "date", "weekday", "time", "demand_kW", "period"]
+    fieldnames = CSV_FIELDNAMES
 
     # **1. 讀取現有數據**，確保唯一性
     existing_data = {}
@@ -740,8 +1762,11 @@ def write_to_csv(filename, new_data):
         writer = csv.DictWriter(file, fieldnames=fieldnames)
         writer.writeheader()
         writer.writerows(existing_data.values())  # 只寫入最新的數據
+    if _trace is not None:
+        trace_count(rows=len(existing_data), bytes_written=os.path.getsize(filename))
 
 # 主調整流程
+@traced("adjust_demand_from_csv")
 def adjust_demand_from_csv(filename, differences, max_demand_limits, peak_values):
     # 1. 讀取並統計
     all_data, period_counts = read_and_count_periods(filename)
@@ -755,6 +1780,96 @@ def adjust_demand_from_csv(filename, differences, max_demand_limits, peak_values
     # 4. 寫回 CSV
     write_to_csv(filename, all_data)
 
+# 時段 → monthly_stats 鍵名中的時段名稱
+PERIOD_STAT_NAMES = {
+    "Peak": "peak",
+    "Half_Peak": "half_peak",
+    "Saturday_Half_Peak": "saturday_half_peak",
+    "Off_Peak": "off_peak"
+}
+
+class PeriodStats:
+    """
+    可合併的各時段需量統計，以時段代碼為索引累加總需量、最大需量與筆數。
+    可逐筆 (add) 或逐批 (update) 累加，不同 worker 或分段的部分結果以 merge 合併。
+    單一電表時各陣列形狀為 (4,)，多電表時為 (電表數, 4)。
+    """
+    __slots__ = ("totals", "maxima", "counts")
+
+    def __init__(self, meter_count=None):
+        shape = (len(PERIODS),) if meter_count is None else (meter_count, len(PERIODS))
+        self.totals = np.zeros(shape)
+        self.maxima = np.zeros(shape)
+        self.counts = np.zeros(shape, dtype=np.int64)
+
+    @classmethod
+    def from_columns(cls, columns):
+        """統計欄位陣列，"demand_kW" 可為一維或 (電表數, 時段數)。"""
+        demand = columns["demand_kW"]
+        stats = cls(None if demand.ndim == 1 else demand.shape[0])
+        stats.update(columns["period"], demand)
+        return stats
+
+    def add(self, code, demand):
+        """累加單一電表的一筆數據。"""
+        self.totals[code] += demand
+        self.counts[code] += 1
+        if demand > self.maxima[code]:
+            self.maxima[code] = demand
+
+    def update(self, period, demand):
+        """
+        累加一批數據。
+
+        參數：
+            period (np.ndarray): 時段代碼
+            demand (np.ndarray): 需量，一維或 (電表數, len(period))，需與建立時的電表數一致
+        """
+        period = np.asarray(period)
+        demand = np.asarray(demand, dtype=float)
+        if demand.ndim == 1:
+            self.totals += np.bincount(period, weights=demand, minlength=len(PERIODS))
+            self.counts += np.bincount(period, minlength=len(PERIODS))
+            np.maximum.at(self.maxima, period, demand)
+            return
+
+        meter_count = demand.shape[0]
+        index = period[None, :] + len(PERIODS) * np.arange(meter_count)[:, None]
+        self.totals += np.bincount(index.ravel(), weights=demand.ravel(), minlength=meter_count * len(PERIODS)).reshape(meter_count, len(PERIODS))
+        self.counts += np.bincount(period, minlength=len(PERIODS))
+        for code in range(len(PERIODS)):
+            mask = period == code
+            if mask.any():
+                np.maximum(self.maxima[:, code], demand[:, mask].max(axis=1), out=self.maxima[:, code])
+
+    def merge(self, other):
+        """合併另一個 PeriodStats（例如另一個 worker 或另一段數據的結果），返回 self。"""
+        self.totals += other.totals
+        self.counts += other.counts
+        np.maximum(self.maxima, other.maxima, out=self.maxima)
+        return self
+
+    def as_dict(self, decimals=2):
+        """
+        轉換為 calculate_monthly_stats 的 monthly_stats 字典（僅限單一電表）。
+
+        參數：
+            decimals (int): 四捨五入的位數，None 表示不四捨五入
+        """
+        monthly_stats = {}
+        for code, period_name in enumerate(PERIODS):
+            name = PERIOD_STAT_NAMES[period_name]
+            monthly_stats[f"max_{name}_demand"] = float(self.maxima[code])
+            monthly_stats[f"total_{name}_demand"] = float(self.totals[code])
+            monthly_stats[f"total_{name}_energy"] = float(self.totals[code]) * (15 / 60)
+        monthly_stats["total_energy"] = float(self.totals.sum()) * (15 / 60)
+        monthly_stats["total_demand"] = float(self.totals.sum())
+        if decimals is not None:
+            for key in monthly_stats:
+                monthly_stats[key] = round(monthly_stats[key], decimals)
+        return monthly_stats
+
+@traced("calculate_monthly_stats_from_csv")
 def calculate_monthly_stats_from_csv(filename, year, month):
     """
     從 CSV 檔案讀取數據，統計指定月份的需量和用電度數數據。
@@ -767,138 +1882,1614 @@ def calculate_monthly_stats_from_csv(filename, year, month):
     返回：
         dict: 包含各時段統計數據的字典
     """
-    # 初始化統計數據
-    monthly_stats = {
-        "max_peak_demand": 0,
-        "max_off_peak_demand": 0,
-        "max_half_peak_demand": 0,
-        "max_saturday_half_peak_demand": 0,
-        "total_peak_demand": 0,
-        "total_off_peak_demand": 0,
-        "total_half_peak_demand": 0,
-        "total_saturday_half_peak_demand": 0,
-        "total_energy": 0,  # 月總用電度數 (kWh)
-        "total_peak_energy": 0,
-        "total_off_peak_energy": 0,
-        "total_half_peak_energy": 0,
-        "total_saturday_half_peak_energy": 0
-    }
+    stats = PeriodStats()
+    try:
+        for chunk in read_csv_chunks(filename, year=year, month=month):
+            stats.update(chunk["period"], chunk["demand_kW"])
+    except FileNotFoundError:
+        print(f"錯誤：找不到檔案 {filename}")
+    except Exception as e:
+        print(f"讀取檔案時發生錯誤：{e}")
+
+    return stats.as_dict()
 
+def calculate_monthly_stats(rows):
+    """
+    統計需量數據的各時段最大需量、總需量和用電度數。
+
+    參數：
+        rows (list): 已過濾為單一月份的需量數據，每個元素包含 "demand_kW" 和 "period"
+
+    返回：
+        dict: 包含各時段統計數據的字典
+    """
+    stats = PeriodStats()
+    for row in rows:
+        stats.add(PERIOD_CODES[row["period"]], float(row["demand_kW"]))
+    return stats.as_dict()
+
+@traced("calculate_monthly_stats_arrays")
+def calculate_monthly_stats_arrays(columns):
+    """
+    calculate_monthly_stats 的欄位陣列版本，以 bincount 一次統計各時段數據。
+
+    參數：
+        columns (dict): 單一月份的欄位陣列，需包含 "period" 和 "demand_kW"
+
+    返回：
+        dict: 與 calculate_monthly_stats 相同鍵名的統計數據
+    """
+    trace_count(rows=len(columns["period"]))
+    return PeriodStats.from_columns(columns).as_dict()
+
+def calibration_bounds(columns, max_demand_limits, peak_values_list):
+    """
+    計算校準時每個時段的需量上限與不可調整的位置。
+    上限為該時段的最高需量限制；有指定峰值的日期再以峰值為上限，讓峰值仍是當日最大值。
+    峰值本身的位置固定不動。
+
+    參數：
+        columns (dict): 連續的欄位陣列
+        max_demand_limits (np.ndarray): 各電表各時段最高需量限制，形狀為 (電表數, 4)
+        peak_values_list (list): 各電表的 PEAK_VALUES
+
+    返回：
+        tuple: (np.ndarray: 上限, np.ndarray: 峰值位置遮罩)，形狀皆為 (電表數, 時段數)
+    """
+    period = columns["period"]
+    upper = np.asarray(max_demand_limits, dtype=float)[:, period]
+    pinned = np.zeros(upper.shape, dtype=bool)
+    if not len(period):
+        return upper, pinned
+
+    start = columns["date"][0]
+    first_slot = int(columns["slot"][0])  # 串流區塊可從一天中間開始
+    for meter_index, peak_values in enumerate(peak_values_list):
+        for time_str, peak_value in peak_values.items():
+            peak_date, peak_time = time_str.split(" ")
+            slot = SLOT_INDEX.get(peak_time)
+            day = int((np.datetime64(peak_date, "D") - start).astype(np.int64))
+            index = day * SLOTS_PER_DAY + (slot if slot is not None else -1) - first_slot
+            if slot is None or not 0 <= index < len(period):
+                continue
+            day_slice = slice(max(day * SLOTS_PER_DAY - first_slot, 0), (day + 1) * SLOTS_PER_DAY - first_slot)
+            np.minimum(upper[meter_index, day_slice], round(float(peak_value), 2), out=upper[meter_index, day_slice])
+            pinned[meter_index, index] = True
+    return upper, pinned
+
+@traced("calibrate_demand_arrays")
+def calibrate_demand_arrays(demand, period, targets, upper, pinned=None):
+    """
+    一次求出各電表各時段的位移量 c，使 Σ clip(需量 + c, 0, 上限) 恰好等於目標總需量（水位填充），
+    再以最大餘數法把四捨五入到 0.01 kW 的誤差分配給各時段，結果與目標逐分相等。
+    不需反覆調整與重新統計，成本為固定次數的排序與累加。
+
+    每個時段 i 的 clip(d_i + c, 0, U_i) 在 c = -d_i 開始增加、在 c = U_i - d_i 達到上限，
+    把兩種轉折點依 (組別, 位置) 排序後累加斜率，即得總需量在每個轉折點的值，再於所在線段內插出 c。
+
+    參數：
+        demand (np.ndarray): 需量，形狀為 (電表數, 時段數)，原地調整
+        period (np.ndarray): 時段代碼，長度為時段數
+        targets (np.ndarray): 各電表各時段的目標總需量 (kW)，形狀為 (電表數, 4)
+        upper (np.ndarray): 各時段的需量上限，形狀同 demand
+        pinned (np.ndarray): 不可調整的位置，形狀同 demand，None 表示全部可調整
+
+    返回：
+        np.ndarray: 無法達成的差額 (kW)，形狀為 (電表數, 4)；只有目標超出 [0, Σ上限] 範圍時不為 0
+    """
+    meter_count = demand.shape[0]
+    group_count = meter_count * len(PERIODS)
+    groups = period[None, :] + len(PERIODS) * np.arange(meter_count)[:, None]
+    free = np.ones(demand.shape, dtype=bool) if pinned is None else ~pinned
+
+    group = groups[free]
+    values = demand[free]
+    bound = upper[free]
+    counts = np.bincount(group, minlength=group_count)
+    goal = np.asarray(targets, dtype=float).reshape(-1) - np.bincount(groups[~free], weights=demand[~free], minlength=group_count)
+    capacity = np.bincount(group, weights=bound, minlength=group_count)
+    reachable = np.clip(goal, 0, capacity)
+
+    # 轉折點：-d_i 時斜率 +1，U_i - d_i 時斜率 -1；c = min(-d_i) 時總和為 0
+    knees = np.concatenate([-values, bound - values])
+    knee_groups = np.concatenate([group, group])
+    slope_steps = np.concatenate([np.ones(len(values)), -np.ones(len(values))])
+    order = np.lexsort((knees, knee_groups))
+    knees, knee_groups, slope_steps = knees[order], knee_groups[order], slope_steps[order]
+
+    active = counts > 0
+    lengths = 2 * counts[active]
+    starts = np.cumsum(lengths) - lengths
+    slopes = np.cumsum(slope_steps)
+    slopes -= np.repeat(slopes[starts] - slope_steps[starts], lengths)
+    rises = np.zeros(len(knees))
+    rises[1:] = slopes[:-1] * np.diff(knees)
+    rises[starts] = 0
+    levels = np.cumsum(rises)
+    levels -= np.repeat(levels[starts], lengths)
+
+    # 每組最後一個總和不超過目標的轉折點，再在其後的線段內插
+    below = np.bincount(knee_groups, weights=levels <= reachable[knee_groups], minlength=group_count)[active].astype(np.int64)
+    at = starts + np.maximum(below, 1) - 1
+    shift = np.zeros(group_count)
+    level_at, slope_at = levels[at], slopes[at]
+    shift[active] = knees[at] + np.divide(reachable[active] - level_at, slope_at, out=np.zeros(len(at)), where=slope_at > 0)
+
+    adjusted = np.clip(values + shift[group], 0, bound)
+
+    # 最大餘數法：先捨去到 0.01 kW，再把剩下的幾個 0.01 kW 給小數部分最大的時段
+    cents = adjusted * 100
+    floors = np.floor(cents + 1e-6)
+    remainders = cents - floors
+    needed = np.rint(reachable * 100) - np.bincount(group, weights=floors, minlength=group_count)
+    order = np.lexsort((-remainders, group))
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order)) - np.repeat(np.cumsum(counts) - counts, counts)
+    floors += (rank < needed[group]) & (floors < np.floor(bound * 100 + 1e-6))
+    demand[free] = floors / 100
+
+    trace_count(rows=demand.size)
+    return (goal - reachable).reshape(meter_count, len(PERIODS))
+
+@traced("adjust_demand_arrays")
+def adjust_demand_arrays(columns, differences, max_demand_limits, peak_values):
+    """
+    adjust_demand + enforce_peak_values 的欄位陣列版本，原地調整 columns["demand_kW"]。
+    以 calibrate_demand_arrays 一次讓各時段總需量移動 differences 指定的量，峰值位置不變。
+
+    參數：
+        columns (dict): 單一月份的欄位陣列
+        differences (dict): 每個時段的總需量差值（kW），來自 compare_energy_with_reference
+        max_demand_limits (dict): 每個時段的最大需量限制（kW）
+        peak_values (dict): 需保留的 PEAK_VALUES
+
+    返回：
+        dict: 調整後的 columns
+    """
+    period = columns["period"]
+    demand = columns["demand_kW"][None, :]
+    totals = np.round(np.bincount(period, weights=demand[0], minlength=len(PERIODS)), 2)
+    targets = totals - np.array([differences.get(period_name, 0) for period_name in PERIODS])
+    limits = np.array([[max_demand_limits[period_name] for period_name in PERIODS]], dtype=float)
+
+    upper, pinned = calibration_bounds(columns, limits, [peak_values])
+    calibrate_demand_arrays(demand, period, np.round(targets, 2)[None, :], upper, pinned)
+    return columns
+
+def calculate_fleet_stats_arrays(columns):
+    """
+    統計多電表數據各時段的總需量與最大需量。
+
+    參數：
+        columns (dict): generate_fleet_arrays 回傳的欄位陣列
+
+    返回：
+        tuple: (totals, maxima)，形狀皆為 (電表數, 4)，單位 kW
+    """
+    stats = PeriodStats.from_columns(columns)
+    return stats.totals, stats.maxima
+
+@traced("adjust_fleet_arrays")
+def adjust_fleet_arrays(columns, reference_totals, max_demand_limits, peak_values_list):
+    """
+    adjust_demand_arrays 的多電表版本：各電表依自己的參考值與需量限制一次校準到參考值。
+
+    參數：
+        columns (dict): generate_fleet_arrays 回傳的欄位陣列，原地調整
+        reference_totals (np.ndarray): 各電表當月各時段參考總需量 (kWh)，形狀為 (電表數, 4)
+        max_demand_limits (np.ndarray): 各電表當月各時段最高需量限制，形狀為 (電表數, 4)
+        peak_values_list (list): 各電表的 PEAK_VALUES
+
+    返回：
+        np.ndarray: 調整前各電表各時段與參考值的差額 (kW)，形狀為 (電表數, 4)
+    """
+    totals, _ = calculate_fleet_stats_arrays(columns)
+    targets = np.round(reference_totals / 0.25, 2)
+    differences = np.round(np.round(totals, 2) - targets, 2)
+
+    upper, pinned = calibration_bounds(columns, max_demand_limits, peak_values_list)
+    calibrate_demand_arrays(columns["demand_kW"], columns["period"], targets, upper, pinned)
+    return differences
+
+@traced("write_columns_to_csv")
+def write_columns_to_csv(filename, columns, meter_no=None):
+    """
+    將欄位陣列直接寫成 CSV（覆寫），格式與 write_to_csv 相同。
+    """
+    with open(filename, "w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(CSV_FIELDNAMES)
+        rows = write_csv_rows(writer, columns, meter_no)
+    if _trace is not None:
+        trace_count(rows=rows, bytes_written=os.path.getsize(filename))
+
+def write_csv_rows(writer, columns, meter_no=None):
+    """以 csv.writer 寫出欄位陣列的資料列（不含標題），回傳筆數；串流流程以此逐塊附加。"""
+    meter_no = get_config().meter_no if meter_no is None else meter_no
+    date_strings = np.datetime_as_string(columns["date"], unit="D").tolist()
+    writer.writerows(
+        (meter_no, record_date, weekday, SLOT_TIMES[slot], demand, PERIODS[period])
+        for record_date, weekday, slot, demand, period in zip(
+            date_strings,
+            columns["weekday"].tolist(),
+            columns["slot"].tolist(),
+            columns["demand_kW"].tolist(),
+            columns["period"].tolist()
+        )
+    )
+    return len(date_strings)
+
+# 需量數據儲存層
+CSV_FIELDNAMES = ["meter_no", "date", "weekday", "time", "demand_kW", "period"]
+
+# 壓縮格式 → 副檔名
+OUTPUT_COMPRESSIONS = {None: "", "gzip": ".gz", "zstd": ".zst"}
+OUTPUT_GZIP_LEVEL = 6  # gzip 預設的 9 級壓縮慢數倍，檔案只小約 2%
+OUTPUT_ZSTD_LEVEL = 3
+OUTPUT_QUEUE_SIZE = 8
+
+def load_zstandard():
+    """zstd 壓縮為選用功能，需要時才匯入 zstandard 套件。"""
     try:
-        with open(filename, "r", encoding="utf-8") as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                # 解析日期並過濾指定年月
-                record_date = datetime.strptime(row["date"], "%Y-%m-%d")
-                if record_date.year != year or record_date.month != month:
-                    continue  # 跳過不屬於指定月份的數據
-
-                # 提取需量並轉換為浮點數
-                demand = float(row["demand_kW"])
-                period = row["period"]
-
-                # 計算用電度數（kWh），假設每筆數據為 15 分鐘間隔
-                energy_kWh = demand * (15 / 60) # 15 分鐘 = 0.25 小時
-
-                # 根據時段更新統計數據
-                if period == "Peak":
-                    monthly_stats["max_peak_demand"] = max(monthly_stats["max_peak_demand"], demand)
-                    monthly_stats["total_peak_demand"] += demand
-                    monthly_stats["total_peak_energy"] += energy_kWh
-                elif period == "Half_Peak":
-                    monthly_stats["max_half_peak_demand"] = max(monthly_stats["max_half_peak_demand"], demand)
-                    monthly_stats["total_half_peak_demand"] += demand
-                    monthly_stats["total_half_peak_energy"] += energy_kWh
-                elif period == "Saturday_Half_Peak":
-                    monthly_stats["max_saturday_half_peak_demand"] = max(monthly_stats["max_saturday_half_peak_demand"], demand)
-                    monthly_stats["total_saturday_half_peak_demand"] += demand
-                    monthly_stats["total_saturday_half_peak_energy"] += energy_kWh
-                else:  # Off_Peak
-                    monthly_stats["max_off_peak_demand"] = max(monthly_stats["max_off_peak_demand"], demand)
-                    monthly_stats["total_off_peak_demand"] += demand
-                    monthly_stats["total_off_peak_energy"] += energy_kWh
-
-        # 計算總用電度數
-        monthly_stats["total_energy"] = (
-            monthly_stats["total_peak_energy"] +
-            monthly_stats["total_half_peak_energy"] +
-            monthly_stats["total_saturday_half_peak_energy"] +
-            monthly_stats["total_off_peak_energy"]
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd 壓縮需要安裝 zstandard 套件（pip install zstandard），或改用 gzip") from None
+    return zstandard
+
+def open_output_file(filename, compression=None):
+    """以文字模式開啟要寫入的 CSV，compression 為 None、"gzip" 或 "zstd"（需安裝 zstandard 套件）。"""
+    if compression == "gzip":
+        return gzip.open(filename, "wt", newline="", encoding="utf-8", compresslevel=OUTPUT_GZIP_LEVEL)
+    if compression == "zstd":
+        compressor = load_zstandard().ZstdCompressor(level=OUTPUT_ZSTD_LEVEL)
+        return io.TextIOWrapper(compressor.stream_writer(open(filename, "wb")), encoding="utf-8", newline="")
+    if compression is not None:
+        raise ValueError(f"不支援的壓縮格式：{compression}")
+    return open(filename, "w", newline="", encoding="utf-8")
+
+def open_input_file(filename):
+    """以二進位模式開啟要讀取的 CSV，依副檔名自動解壓縮 .gz 與 .zst。"""
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "rb")
+    if filename.endswith(".zst"):
+        return io.BufferedReader(load_zstandard().ZstdDecompressor().stream_reader(open(filename, "rb"), closefd=True))
+    return open(filename, "rb")
+
+class OutputSink:
+    """
+    在背景執行緒寫出 CSV：write() 只把欄位陣列放進有上限的佇列，格式化、壓縮與寫檔在背景進行，
+    主執行緒可以繼續生成下一批數據。佇列滿時 write() 會等待，待寫出的數據量不超過 queue_size 塊。
+    背景執行緒發生的錯誤在下一次 write() 或 close() 時拋出。
+
+    傳給 write() 的陣列在寫出前不可再修改。
+    """
+
+    def __init__(self, compression=None, queue_size=OUTPUT_QUEUE_SIZE):
+        if compression not in OUTPUT_COMPRESSIONS:
+            raise ValueError(f"不支援的壓縮格式：{compression}")
+        if compression == "zstd":
+            load_zstandard()  # 在開始生成前就回報缺少的套件
+        self.compression = compression
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.files = {}  # 保持開啟的檔案（串流附加）
+        self.error = None
+        self.rows = 0
+        self.bytes_written = 0
+        self.thread = threading.Thread(target=self.run, name="output-sink", daemon=True)
+        self.thread.start()
+
+    def path(self, filename):
+        """加上壓縮格式的副檔名。"""
+        return filename + OUTPUT_COMPRESSIONS[self.compression]
+
+    def write(self, filename, columns, meter_no=None, keep_open=False):
+        """
+        將欄位陣列排入佇列寫成 CSV（覆寫）。keep_open 為 True 時寫完不關檔，之後同一檔名的 write() 附加在後面，
+        直到 close() 才關閉。
+
+        返回：
+            str: 實際寫出的路徑（含壓縮副檔名）
+        """
+        if self.error is not None:
+            raise self.error
+        path = self.path(filename)
+        meter_no = get_config().meter_no if meter_no is None else meter_no
+        with trace_stage("output_sink_wait"):
+            self.queue.put((path, columns, meter_no, keep_open))
+        return path
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                if self.error is None:
+                    self.write_job(*job)
+            except BaseException as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def write_job(self, path, columns, meter_no, keep_open):
+        file = self.files.pop(path, None)
+        if file is None:
+            file = open_output_file(path, self.compression)
+            csv.writer(file).writerow(CSV_FIELDNAMES)
+        self.rows += write_csv_rows(csv.writer(file), columns, meter_no)
+        if keep_open:
+            self.files[path] = file
+        else:
+            self.close_file(path, file)
+
+    def close_file(self, path, file):
+        file.close()
+        self.bytes_written += os.path.getsize(path)
+
+    def close(self):
+        """等待佇列寫完並關閉所有檔案。"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        for path, file in list(self.files.items()):
+            self.close_file(path, file)
+        self.files = {}
+        trace_count("output_sink", rows=self.rows, bytes_written=self.bytes_written)
+        self.rows = self.bytes_written = 0
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def month_date_range(year, month=None):
+    """回傳 ("YYYY-MM-01", "YYYY-MM-<月底>")，用於以日期字串範圍查詢整月數據；month 為 None 時為整年。"""
+    if month is None:
+        return f"{year}-01-01", f"{year}-12-31"
+    return f"{year}-{month:02d}-01", f"{year}-{month:02d}-{month_days(year, month):02d}"
+
+CSV_CHUNK_SIZE = 65536  # read_csv_chunks 每個區塊的最大筆數
+
+def csv_index_path(filename):
+    return f"{filename}.idx.json"
+
+def build_csv_index(filename):
+    """
+    掃描一次 CSV，記錄每個 (電表, 年月) 連續數據的位元組範圍，寫入 <filename>.idx.json。
+    索引記錄來源檔的 mtime 與大小，檔案改變後自動失效。
+
+    返回：
+        dict: {"mtime_ns", "size", "ranges": {"電表|YYYY-MM": [[起點, 終點], ...]}}
+    """
+    stat = os.stat(filename)
+    ranges = {}
+    with open(filename, "rb") as file:
+        header = file.readline()
+        fields = header.decode("utf-8-sig").strip().split(",")
+        meter_column, date_column = fields.index("meter_no"), fields.index("date")
+        offset = start = len(header)
+        current_key = None
+        for line in file:
+            values = line.split(b",")
+            if len(values) > max(meter_column, date_column):
+                key = f"{values[meter_column].decode('utf-8')}|{values[date_column][:7].decode('utf-8')}"
+                if key != current_key:
+                    if current_key is not None:
+                        ranges.setdefault(current_key, []).append([start, offset])
+                    current_key, start = key, offset
+            offset += len(line)
+        if current_key is not None:
+            ranges.setdefault(current_key, []).append([start, offset])
+
+    index = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "ranges": ranges}
+    with open(csv_index_path(filename), "w", encoding="utf-8") as file:
+        json.dump(index, file)
+    return index
+
+def load_csv_index(filename):
+    """讀取 CSV 的索引，沒有索引或來源檔已改變時回傳 None。"""
+    try:
+        stat = os.stat(filename)
+        with open(csv_index_path(filename), "r", encoding="utf-8") as file:
+            index = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if (index.get("mtime_ns"), index.get("size")) != (stat.st_mtime_ns, stat.st_size):
+        return None
+    return index
+
+def csv_rows_to_columns(rows, positions, date_cache):
+    """將一批已拆分的 CSV 列轉為欄位陣列；日期字串只在第一次出現時解析並記入 date_cache。"""
+    meter_column, date_column, time_column, demand_column, period_column = positions
+    date_strings = [values[date_column] for values in rows]
+    for date_string in set(date_strings).difference(date_cache):
+        date_cache[date_string] = np.datetime64(date_string, "D")
+    dates = np.array([date_cache[date_string] for date_string in date_strings], dtype="datetime64[D]")
+    return {
+        "meter_no": np.array([values[meter_column] for values in rows]),
+        "date": dates,
+        "weekday": ((dates.astype(np.int64) + 3) % 7).astype(np.int8),  # 1970-01-01 為星期四
+        "slot": np.array([SLOT_INDEX[values[time_column]] for values in rows], dtype=np.int16),
+        "period": np.array([PERIOD_CODES[values[period_column]] for values in rows], dtype=np.uint8),
+        "demand_kW": np.array([values[demand_column] for values in rows], dtype=float)
+    }
+
+def read_csv_chunks(filename, meter_no=None, year=None, month=None, chunk_size=CSV_CHUNK_SIZE, use_index=True):
+    """
+    以欄位陣列區塊串流讀取本模組寫出的需量 CSV，不一次載入整個檔案。
+
+    (電表, 年, 月) 篩選在解析前以字串比對完成，不符合的列不會被轉換。
+    指定年份且 use_index 為 True 時，以 build_csv_index 的索引直接跳到符合的位元組範圍
+    （沒有有效索引時先掃描一次建立），其餘部分不會被讀取。壓縮的 .gz 與 .zst 檔案自動解壓縮並整檔掃描。
+
+    參數：
+        filename (str): CSV 檔案路徑
+        meter_no (str): 只讀取此電表，None 表示全部
+        year (int): 只讀取此年份，None 表示全部
+        month (int): 只讀取此月份（需同時指定 year），None 表示整年
+        chunk_size (int): 每個區塊的最大筆數
+        use_index (bool): 是否使用索引跳讀
+
+    Yields:
+        dict: 欄位陣列 {"meter_no", "date", "weekday", "slot", "period", "demand_kW"}
+    """
+    prefix = "" if year is None else (f"{year}-" if month is None else f"{year}-{month:02d}-")
+    ranges = None
+    if prefix and use_index and not filename.endswith((".gz", ".zst")):
+        index = load_csv_index(filename)
+        if index is None and os.path.exists(filename):
+            try:
+                index = build_csv_index(filename)
+            except OSError:
+                index = None  # 無法寫入索引時改為整檔掃描
+        if index is not None:
+            ranges = []
+            for key, key_ranges in index["ranges"].items():
+                key_meter, year_month = key.split("|")
+                if (meter_no is None or key_meter == meter_no) and f"{year_month}-".startswith(prefix):
+                    ranges.extend(key_ranges)
+            ranges.sort()
+
+    with open_input_file(filename) as file:
+        fields = file.readline().decode("utf-8-sig").strip().split(",")
+        positions = [fields.index(name) for name in ("meter_no", "date", "time", "demand_kW", "period")]
+        meter_column, date_column = positions[0], positions[1]
+        width = max(positions) + 1
+
+        def lines():
+            if ranges is None:
+                yield from file
+                return
+            for start, end in ranges:
+                file.seek(start)
+                yield from file.read(end - start).splitlines()
+
+        date_cache = {}
+        rows = []
+        row_count = 0
+        for line in lines():
+            values = line.decode("utf-8").rstrip("\r\n").split(",")
+            if len(values) < width:
+                continue
+            if meter_no is not None and values[meter_column] != meter_no:
+                continue
+            if not values[date_column].startswith(prefix):
+                continue
+            rows.append(values)
+            if len(rows) >= chunk_size:
+                row_count += len(rows)
+                yield csv_rows_to_columns(rows, positions, date_cache)
+                rows = []
+        if rows:
+            row_count += len(rows)
+            yield csv_rows_to_columns(rows, positions, date_cache)
+        if _trace is not None:
+            bytes_read = file.tell() if ranges is None else len(",".join(fields)) + sum(end - start for start, end in ranges)
+            trace_count("read_csv_chunks", rows=row_count, bytes_read=bytes_read)
+
+class CSVDemandStore:
+    """
+    以單一 CSV 檔案儲存需量數據（原本 write_to_csv 的讀取-合併-覆寫行為）。
+    每次寫入成本與檔案大小成正比，僅供相容使用。
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def upsert(self, rows):
+        write_to_csv(self.filename, rows)
+
+    def upsert_columns(self, columns, meter_no=None):
+        self.upsert(demand_arrays_to_records(columns, meter_no))
+
+    def read(self, meter_no=None, year=None, month=None):
+        if not os.path.exists(self.filename):
+            return []
+        first, last = month_date_range(year, month) if year is not None else ("", "~")
+        with open(self.filename, "r", newline="", encoding="utf-8") as file:
+            return [
+                row for row in csv.DictReader(file)
+                if (meter_no is None or row["meter_no"] == meter_no) and first <= row["date"] <= last
+            ]
+
+    def export_csv(self, filename, meter_no=None, year=None, month=None):
+        rows = self.read(meter_no, year, month)
+        with open(filename, "w", newline="", encoding="utf-8") as file:
+            writer = csv.DictWriter(file, fieldnames=CSV_FIELDNAMES)
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class SQLiteDemandStore:
+    """
+    以本機 SQLite 資料表儲存需量數據，主鍵為 (meter_no, date, time)。
+    寫入為 upsert，成本與新數據筆數成正比，與既有數據量無關；CSV 只在最後匯出。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS demand ("
+            " meter_no TEXT NOT NULL,"
+            " date TEXT NOT NULL,"
+            " weekday INTEGER NOT NULL,"
+            " time TEXT NOT NULL,"
+            " demand_kW REAL NOT NULL,"
+            " period TEXT NOT NULL,"
+            " PRIMARY KEY (meter_no, date, time)"
+            ") WITHOUT ROWID"
+        )
+        self.connection.commit()
+
+    def upsert(self, rows):
+        """寫入或更新需量數據，rows 為 list-of-dicts。"""
+        self.upsert_tuples(
+            (row["meter_no"], row["date"], int(row["weekday"]), row["time"],
+             round(float(row["demand_kW"]), 2), row["period"])
+            for row in rows
         )
 
-        monthly_stats["total_demand"] = (
-            monthly_stats["total_peak_demand"] +
-            monthly_stats["total_half_peak_demand"] +
-            monthly_stats["total_off_peak_demand"] +
-            monthly_stats["total_saturday_half_peak_demand"]
+    @traced("store_upsert")
+    def upsert_columns(self, columns, meter_no=None):
+        """直接寫入 generate_demand_arrays 的欄位陣列，不需先轉換為 list-of-dicts。"""
+        config = get_config()
+        meter_no = config.meter_no if meter_no is None else meter_no
+        date_strings = np.datetime_as_string(columns["date"], unit="D").tolist()
+        trace_count(rows=len(date_strings))
+        self.upsert_tuples(
+            (meter_no, record_date, weekday, SLOT_TIMES[slot], round(demand, 2), PERIODS[period])
+            for record_date, weekday, slot, demand, period in zip(
+                date_strings,
+                columns["weekday"].tolist(),
+                columns["slot"].tolist(),
+                columns["demand_kW"].tolist(),
+                columns["period"].tolist()
+            )
         )
-        for key in monthly_stats:
-            monthly_stats[key] = round(monthly_stats[key], 2)
 
-    except FileNotFoundError:
-        print(f"錯誤：找不到檔案 {filename}")
-    except Exception as e:
-        print(f"讀取檔案時發生錯誤：{e}")
+    def upsert_tuples(self, tuples):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO demand (meter_no, date, weekday, time, demand_kW, period) VALUES (?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (meter_no, date, time) DO UPDATE SET"
+                " weekday = excluded.weekday, demand_kW = excluded.demand_kW, period = excluded.period",
+                tuples
+            )
+
+    def read(self, meter_no=None, year=None, month=None):
+        """讀取需量數據（依 meter_no、date、time 排序），可依電表與年月過濾。"""
+        query = "SELECT meter_no, date, weekday, time, demand_kW, period FROM demand"
+        conditions, parameters = [], []
+        if meter_no is not None:
+            conditions.append("meter_no = ?")
+            parameters.append(meter_no)
+        if year is not None:
+            conditions.append("date BETWEEN ? AND ?")
+            parameters.extend(month_date_range(year, month))
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY meter_no, date, time"
+        cursor = self.connection.execute(query, parameters)
+        return [dict(zip(CSV_FIELDNAMES, row)) for row in cursor]
+
+    def export_csv(self, filename, meter_no=None, year=None, month=None):
+        """將數據匯出為與 write_to_csv 相同格式的 CSV 檔案。"""
+        rows = self.read(meter_no, year, month)
+        with open(filename, "w", newline="", encoding="utf-8") as file:
+            writer = csv.DictWriter(file, fieldnames=CSV_FIELDNAMES)
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# 二進位時段格式：每個 (電表, 月份) 一個檔案，64 位元組檔頭後接每 15 分鐘一筆的固定長度紀錄。
+# 日期由檔頭的起始日加上紀錄位置推得，電表編號在檔頭與分割路徑中，不需逐筆儲存。
+INTERVAL_MAGIC = b"DEMANDIV"
+INTERVAL_VERSION = 1
+INTERVAL_HEADER = struct.Struct("<8sHHiq32s8x")  # magic, 版本, 每日時段數, 筆數, 起始日 (epoch 日數), meter_no
+INTERVAL_METER_NO_BYTES = 32
+INTERVAL_DTYPE = np.dtype([("demand_kW", "<f4"), ("period", "u1")])  # 每筆 5 位元組
+
+@traced("write_interval_file")
+def write_interval_file(path, columns, meter_no=None):
+    """
+    將連續的單一電表欄位陣列寫成二進位時段檔（先寫暫存檔再改名）。
+    需量以 float32 儲存，65536 kW 以下的 0.01 kW 精度可完整還原。
+    """
+    meter_no = get_config().meter_no if meter_no is None else meter_no
+    encoded_meter_no = meter_no.encode("utf-8")
+    if len(encoded_meter_no) > INTERVAL_METER_NO_BYTES:
+        raise ValueError(f"電表編號 {meter_no} 超過 {INTERVAL_METER_NO_BYTES} 位元組，無法寫入時段檔標頭")
+    records = np.empty(len(columns["period"]), dtype=INTERVAL_DTYPE)
+    records["demand_kW"] = columns["demand_kW"]
+    records["period"] = columns["period"]
+    start = columns["date"][0].astype("datetime64[D]").astype(np.int64) if len(records) else 0
+    header = INTERVAL_HEADER.pack(INTERVAL_MAGIC, INTERVAL_VERSION, SLOTS_PER_DAY, len(records), start, encoded_meter_no)
+
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as file:
+        file.write(header)
+        file.write(records.tobytes())
+    os.replace(temporary_path, path)
+    trace_count(rows=len(records), bytes_written=len(header) + records.nbytes)
+
+@traced("open_interval_file")
+def open_interval_file(path, mode="r"):
+    """
+    以 numpy.memmap 開啟二進位時段檔，不解析任何文字。
+
+    參數：
+        path (str): 檔案路徑
+        mode (str): "r" 唯讀，"r+" 可就地修改
 
-    return monthly_stats
+    返回：
+        tuple: (dict: 欄位陣列，"demand_kW" 與 "period" 為 memmap 上的視圖, str: meter_no)
+    """
+    with open(path, "rb") as file:
+        magic, version, slots_per_day, count, start, meter_no = INTERVAL_HEADER.unpack(file.read(INTERVAL_HEADER.size))
+    if magic != INTERVAL_MAGIC or version != INTERVAL_VERSION or slots_per_day != SLOTS_PER_DAY:
+        raise ValueError(f"{path} 不是支援的二進位時段檔")
+
+    records = np.memmap(path, dtype=INTERVAL_DTYPE, mode=mode, offset=INTERVAL_HEADER.size, shape=(count,)) if count else np.empty(0, dtype=INTERVAL_DTYPE)
+    days = start + np.arange(count) // SLOTS_PER_DAY
+    columns = {
+        "date": days.astype("datetime64[D]"),
+        "weekday": ((days + 3) % 7).astype(np.int8),  # 1970-01-01 為星期四
+        "slot": (np.arange(count) % SLOTS_PER_DAY).astype(np.int16),
+        "period": records["period"],
+        "demand_kW": records["demand_kW"]
+    }
+    trace_count(rows=count, bytes_read=INTERVAL_HEADER.size + records.nbytes)
+    return columns, meter_no.rstrip(b"\0").decode("utf-8")
+
+def records_to_columns(rows):
+    """將 list-of-dicts 需量數據依電表分組轉為欄位陣列，回傳 {meter_no: columns}。"""
+    grouped = {}
+    for row in rows:
+        grouped.setdefault(row["meter_no"], []).append(row)
+    result = {}
+    for meter_no, meter_rows in grouped.items():
+        dates = np.array([row["date"] for row in meter_rows], dtype="datetime64[D]")
+        result[meter_no] = {
+            "date": dates,
+            "weekday": ((dates.astype(np.int64) + 3) % 7).astype(np.int8),
+            "slot": np.array([SLOT_INDEX[row["time"]] for row in meter_rows], dtype=np.int16),
+            "period": np.array([PERIOD_CODES[row["period"]] for row in meter_rows], dtype=np.uint8),
+            "demand_kW": np.array([float(row["demand_kW"]) for row in meter_rows])
+        }
+    return result
+
+class IntervalDemandStore:
+    """
+    以二進位時段檔儲存需量數據：<root>/meter=<meter_no>/<YYYY>-<MM>.dmd，每個檔案為一個電表的一整個月。
+    讀取以 memmap 進行，統計、電費與繪圖可直接使用；CSV 只作為匯出格式。
+    月份檔建立時需量為 NaN（尚未寫入），時段代碼依電價表填入，寫入時依日期與時段直接計算位置。
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, meter_no, year, month):
+        return os.path.join(self.root, f"meter={meter_no}", f"{year}-{month:02d}.dmd")
+
+    def month_file(self, meter_no, year, month):
+        """開啟（必要時先建立）月份檔，回傳可就地修改的欄位陣列。"""
+        path = self.path(meter_no, year, month)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            columns = calendar_columns(date(year, month, 1), date(year, month, calendar.monthrange(year, month)[1]))[0]
+            columns["demand_kW"] = np.full(len(columns["period"]), np.nan)
+            write_interval_file(path, columns, meter_no)
+        return open_interval_file(path, mode="r+")[0]
+
+    def upsert(self, rows):
+        """寫入或更新需量數據，rows 為 list-of-dicts。"""
+        for meter_no, columns in records_to_columns(rows).items():
+            self.upsert_columns(columns, meter_no)
+
+    @traced("store_upsert")
+    def upsert_columns(self, columns, meter_no=None):
+        """寫入欄位陣列，可跨月份；整月的數據直接寫成新檔，其餘就地更新。"""
+        meter_no = get_config().meter_no if meter_no is None else meter_no
+        trace_count(rows=len(columns["period"]))
+        dates = columns["date"].astype("datetime64[D]")
+        month_keys = dates.astype("datetime64[M]")
+        for month_start in np.unique(month_keys):
+            rows = np.flatnonzero(month_keys == month_start)
+            year, month = int(str(month_start)[:4]), int(str(month_start)[5:7])
+            day_count = calendar.monthrange(year, month)[1]
+            offsets = (dates[rows] - month_start.astype("datetime64[D]")).astype(np.int64) * SLOTS_PER_DAY + columns["slot"][rows]
+            if len(rows) == day_count * SLOTS_PER_DAY and (offsets == np.arange(len(rows))).all():
+                path = self.path(meter_no, year, month)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                write_interval_file(path, {name: values[rows] for name, values in columns.items()}, meter_no)
+                continue
+            target = self.month_file(meter_no, year, month)
+            target["demand_kW"][offsets] = columns["demand_kW"][rows]
+            target["period"][offsets] = columns["period"][rows]
+            target["demand_kW"].base.flush()
+
+    def meters(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name[len("meter="):] for name in os.listdir(self.root) if name.startswith("meter="))
+
+    def read_columns(self, meter_no=None, year=None, month=None):
+        """
+        以 memmap 讀取欄位陣列，可依電表與年月過濾；尚未寫入 (NaN) 的時段不會回傳。
+        整月都已寫入時直接回傳 memmap，否則回傳已寫入時段的複本。
+
+        Yields:
+            tuple: (meter_no, dict: 單一電表單月的欄位陣列)，依電表與年月排序
+        """
+        meter_numbers = self.meters() if meter_no is None else [meter_no]
+        prefix = "" if year is None else (f"{year}-" if month is None else f"{year}-{month:02d}.")
+        for meter in meter_numbers:
+            partition = os.path.join(self.root, f"meter={meter}")
+            if not os.path.isdir(partition):
+                continue
+            for name in sorted(os.listdir(partition)):
+                if name.endswith(".dmd") and name.startswith(prefix):
+                    columns = open_interval_file(os.path.join(partition, name))[0]
+                    written = ~np.isnan(columns["demand_kW"])
+                    yield meter, columns if written.all() else {column: values[written] for column, values in columns.items()}
+
+    def read(self, meter_no=None, year=None, month=None):
+        """讀取需量數據為 list-of-dicts（依 meter_no、date、time 排序），略過尚未寫入的時段。"""
+        rows = []
+        for meter, columns in self.read_columns(meter_no, year, month):
+            meter_columns = dict(columns, demand_kW=np.round(columns["demand_kW"].astype(float), 2))
+            rows.extend(demand_arrays_to_records(meter_columns, meter))
+        return rows
+
+    def export_csv(self, filename, meter_no=None, year=None, month=None):
+        """將數據匯出為與 write_to_csv 相同格式的 CSV 檔案。"""
+        rows = self.read(meter_no, year, month)
+        with open(filename, "w", newline="", encoding="utf-8") as file:
+            writer = csv.DictWriter(file, fieldnames=CSV_FIELDNAMES)
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def open_demand_store(path):
+    """
+    依路徑選擇儲存後端：.csv 使用 CSVDemandStore，目錄或 .dmd 結尾使用 IntervalDemandStore，
+    其他使用 SQLiteDemandStore。
+    """
+    if path.lower().endswith(".csv"):
+        return CSVDemandStore(path)
+    if path.lower().endswith(".dmd") or os.path.isdir(path):
+        return IntervalDemandStore(path)
+    return SQLiteDemandStore(path)
 
 # 主程序
-def main():
-    # 處理 4 月、5 月和 7 月
-    for month in range(1, 13):  # 1 月到 12 月
-        PEAK_VALUES = PEAK_VALUES_DICT.get(month, {})  # 如果沒有 PEAK_VALUES，設為空字典
-        max_demand_limits = MAX_DEMAND_LIMITS_DICT[month]  # 所有月份都有 max_demand_limits
-        REFERENCE_TOTAL_DEMANDS = REFERENCE_TOTAL_DEMANDS_DICT[month]
-
-        # 遍歷該月的 PEAK_VALUES（如果有）
-        if PEAK_VALUES:
-            for time, value in PEAK_VALUES.items():
-                dt = datetime.strptime(time, "%Y-%m-%d %H:%M")
-                year = dt.year
-                month = dt.month
-                day = dt.day
-                hour = dt.hour
-                minute = dt.minute
-                peak_time = f"{hour:02d}:{minute:02d}"
-
-                # 生成整個月數據
-                days_in_month = MONTHS.get(month, 31)
-                all_month_data = generate_daily_demand_data(
-                    year=year,
-                    month=month,
-                    start_day=1,
-                    end_day=days_in_month,
-                    peak_time=peak_time,
-                    peak_value=value
-                )
-
-                filename = f"factory_demand_data{year}_{month}.csv"
-                write_to_csv(filename, all_month_data)
+@traced("simulate_month")
+def simulate_month(year, month, peak_values=None, rng=None):
+    """
+    記憶體內的單月流程：生成 → 統計 → 比較 → 調整 → 重新統計，全程以欄位陣列傳遞，不讀寫檔案。
+
+    參數：
+        year (int): 年份
+        month (int): 月份
+        peak_values (dict): 該月的 PEAK_VALUES，可為空
+        rng (np.random.Generator): 隨機數產生器，None 時使用模組預設產生器
+
+    返回：
+        tuple: (dict: 調整後的欄位陣列, dict: 調整後的 monthly_stats, dict: 與參考值的差額)
+    """
+    config = get_config()
+    peak_values = peak_values or {}
+    max_demand_limits = config.max_demand_limits[month]
+    reference_total_demands = config.reference_total_demands[month]
+
+    columns = generate_demand_arrays(
+        date(year, month, 1),
+        date(year, month, month_days(year, month)),
+        peak_values=peak_values,
+        rng=rng
+    )
+    monthly_stats = calculate_monthly_stats_arrays(columns)
+    differences = compare_energy_with_reference(monthly_stats, reference_total_demands, year, month)
+    adjust_demand_arrays(columns, differences, max_demand_limits, peak_values)
+    monthly_stats = calculate_monthly_stats_arrays(columns)
+    differences = compare_energy_with_reference(monthly_stats, reference_total_demands, year, month)
+    return columns, monthly_stats, differences
+
+def stream_bound(value, end=False):
+    """
+    將串流的起訖時間轉為 (日期, 15 分鐘時段索引)。date 或 "YYYY-MM-DD" 表示整天：起點為 00:00，終點為 23:45。
+    """
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value) if len(value) > 10 else date.fromisoformat(value)
+    if isinstance(value, datetime):
+        return value.date(), (value.hour * 60 + value.minute) // 15
+    return value, SLOTS_PER_DAY - 1 if end else 0
+
+def stream_bounds(start, end):
+    """
+    以 stream_bound 轉換串流的起訖時間，結束時間早於起始時間時引發 ValueError。
+
+    返回：
+        tuple: ((起始日, 起始時段), (結束日, 結束時段))
+    """
+    first, last = stream_bound(start), stream_bound(end, end=True)
+    if last < first:
+        raise ValueError(f"串流的結束時間 {end} 早於起始時間 {start}")
+    return first, last
+
+def stream_date_chunks(start_date, end_date, chunk_days=STREAM_CHUNK_DAYS):
+    """
+    將 start_date 到 end_date（含）切成最多 chunk_days 天的區塊，區塊不跨月份。
+
+    產出：
+        tuple: (date: 區塊第一天, date: 區塊最後一天)
+    """
+    day = start_date
+    while day <= end_date:
+        month_end = date(day.year, day.month, month_days(day.year, day.month))
+        last = min(end_date, month_end, day + timedelta(days=chunk_days - 1))
+        yield day, last
+        day = last + timedelta(days=1)
+
+def generate_demand_stream(start, end, peak_values=None, chunk_days=STREAM_CHUNK_DAYS, rng=None):
+    """
+    以生成器逐塊產生 start 到 end 的單一電表需量，任意跨月、跨年（含閏年二月與夏月起訖日）。
+    只保留目前與下一塊的數據，記憶體與期間長度無關。平滑以 moving_average_stream 跨區塊邊界連續計算，
+    抽樣、平滑與釘選峰值的結果與對整段期間呼叫 generate_demand_arrays 相同（rng 為單一產生器時）。
+
+    參數：
+        start (datetime, date 或 str): 起始時間（含），日期表示當天 00:00
+        end (datetime, date 或 str): 結束時間（含該時段），日期表示當天 23:45
+        peak_values (dict): 每日峰值，可跨多個年份
+        chunk_days (int): 每塊的天數，區塊不跨月份
+        rng (np.random.Generator 或 callable): 隨機數產生器；傳入 callable(year, month) 時每個月份使用各自的產生器，
+            各月份的抽樣從該月第一個產生的時段開始，因此起始日為月初時，整月的抽樣結果與起始時刻及結束時間無關。
+            None 時使用模組預設產生器
+
+    產出：
+        dict: 欄位陣列 {"date", "weekday", "slot", "period", "demand_kW"}
+    """
+    config = get_config()
+    (start_date, first_slot), (end_date, last_slot) = stream_bounds(start, end)
+    rng = _rng if rng is None else rng
+    default_peak_value = config.base_demand_range[0] * 1.5
+    max_demand_limits_tables = config.max_demand_limits_table[None]
+
+    peaks_by_day = {}
+    for time_str, value in (peak_values or {}).items():
+        peaks_by_day.setdefault(time_str.split(" ")[0], {})[time_str] = value
+
+    month_rngs = {}
+    pending = []  # 已抽樣、等待平滑結果的區塊：(欄位陣列, 當天峰值, 是否為最後一塊)
+
+    def sample_chunks():
+        for chunk_start, chunk_end in stream_date_chunks(start_date, end_date, chunk_days):
+            columns, dates, months = calendar_columns(chunk_start, chunk_end)
+            chunk_peaks = {}
+            for day in np.datetime_as_string(dates, unit="D").tolist():
+                chunk_peaks.update(peaks_by_day.get(day, {}))
+            if callable(rng):
+                month_key = (chunk_start.year, chunk_start.month)
+                if month_key not in month_rngs:
+                    month_rngs.clear()
+                    month_rngs[month_key] = rng(*month_key)
+                chunk_rng = month_rngs[month_key]
+            else:
+                chunk_rng = rng
+            pending.append((columns, chunk_peaks, chunk_end == end_date))
+            yield sample_demand_arrays(columns, dates, months, max_demand_limits_tables, [chunk_peaks], default_peak_value, [chunk_rng])[0]
+
+    # moving_average_stream 的輸出會落後輸入，累積到足夠一個區塊時才依原本的區塊切分產出
+    smoothed = np.empty(0)
+    skip = first_slot
+    for block in moving_average_stream(sample_chunks(), window_size=SMOOTHING_WINDOW):
+        smoothed = np.concatenate((smoothed, block))
+        while pending and len(smoothed) >= len(pending[0][0]["period"]):
+            columns, chunk_peaks, last = pending.pop(0)
+            length = len(columns["period"])
+            columns["demand_kW"], smoothed = smoothed[:length], smoothed[length:]
+            pin_peak_values_array(columns, chunk_peaks)
+            stop = length - (SLOTS_PER_DAY - 1 - last_slot) if last else length
+            yield {name: values[skip:stop] for name, values in columns.items()} if skip or stop < length else columns
+            skip = 0
+
+def calibrate_demand_stream(chunks, peak_values=None):
+    """
+    將需量區塊依月份校準到 REFERENCE_TOTAL_DEMANDS：同一個月的區塊先暫存，月份結束時以 calibrate_demand_arrays
+    一次調整後再依原本的區塊產出，記憶體上限為一個月。只涵蓋部分月份時，參考值依涵蓋的時段比例縮減。
+
+    參數：
+        chunks (iterable): 依時間順序、不跨月份的欄位陣列區塊（例如 generate_demand_stream 的輸出）
+        peak_values (dict): 需保留的每日峰值
+
+    產出：
+        dict: 校準後的欄位陣列區塊
+    """
+    config = get_config()
+    peak_values = peak_values or {}
+
+    def calibrate(buffered):
+        columns = {name: np.concatenate([chunk[name] for chunk in buffered]) for name in buffered[0]}
+        first_date = columns["date"][0].astype(object)
+        year, month = first_date.year, first_date.month
+        share = len(columns["period"]) / (month_days(year, month) * SLOTS_PER_DAY)
+        targets = np.round(config.reference_total_demands_table[month] / 0.25 * share, 2)
+        upper, pinned = calibration_bounds(columns, config.max_demand_limits_table[month][None], [month_peak_values(peak_values, year, month)])
+        residual = calibrate_demand_arrays(columns["demand_kW"][None, :], columns["period"], targets[None], upper, pinned)
+        target_sum = targets.sum()
+        deviation = residual.sum() / target_sum * 100 if target_sum else 0.0
+        print(f"{year}-{month:02d}：涵蓋 {share:.0%} 的時段，總用電與參考值偏差 {deviation:.2f}%")
+        boundaries = np.cumsum([len(chunk["period"]) for chunk in buffered])[:-1]
+        for index in range(len(buffered)):
+            start = boundaries[index - 1] if index else 0
+            stop = boundaries[index] if index < len(boundaries) else len(columns["period"])
+            yield {name: values[start:stop] for name, values in columns.items()}
+
+    buffered = []
+    for chunk in chunks:
+        if buffered and chunk["date"][0].astype("datetime64[M]") != buffered[0]["date"][0].astype("datetime64[M]"):
+            yield from calibrate(buffered)
+            buffered = []
+        buffered.append(chunk)
+    if buffered:
+        yield from calibrate(buffered)
+
+def run_stream(start, end, entropy, store, chunk_days=STREAM_CHUNK_DAYS, plot=False, plot_workers=1, compression=None, sink=None,
+               profile=None):
+    """
+    以串流流程模擬任意期間：逐塊生成 → 依月份校準 → 附加寫入 CSV 與儲存層（→ 繪製每日圖表），
+    記憶體與期間長度無關。同一個種子下，從月初開始的月份與 run_month 使用相同的隨機數流。
+    CSV 由 sink（None 時自行建立）在背景附加寫出；有 profile 時逐塊累加契約容量試算資料。
+    CSVDemandStore 每次寫入都會讀取並覆寫整個檔案，逐塊寫入的成本與期間長度成平方關係，因此不支援。
+
+    返回：
+        int: 寫出的時段數
+    """
+    if isinstance(store, CSVDemandStore):
+        raise ValueError(f"串流模式不支援 CSV 儲存層 ({store.filename})，請改用 .db 或 .dmd")
+    config = get_config()
+    (start_date, _), (end_date, _) = stream_bounds(start, end)
+    peak_values = {}
+    for month_peaks in config.peak_values.values():
+        peak_values.update(month_peaks)
+
+    rng = functools.partial(meter_month_rng, entropy, config.meter_no)
+    chunks = calibrate_demand_stream(generate_demand_stream(start, end, peak_values, chunk_days, rng), peak_values)
+    filename = f"factory_demand_data{start_date:%Y%m%d}_{end_date:%Y%m%d}.csv"
+    rows = 0
+    sink_scope = OutputSink(compression) if sink is None else contextlib.nullcontext(sink)
+    # 繪圖的行程池在整個期間共用，不為每個區塊重新建立
+    plot_scope = worker_pool(plot_workers) if plot and plot_workers > 1 else contextlib.nullcontext()
+    with sink_scope as sink, plot_scope as plot_executor, trace_stage("run_stream"):
+        path = sink.path(filename)
+        for chunk in chunks:
+            first_date = chunk["date"][0].astype(object)
+            with trace_context(year=first_date.year, month=first_date.month, meter_no=config.meter_no):
+                sink.write(filename, chunk, keep_open=True)
+                rows += len(chunk["period"])
+                store.upsert_columns(chunk)
+                if profile is not None:
+                    profile.update(chunk)
+                if plot:
+                    plot_demand_arrays(chunk, first_date.year, first_date.month, workers=plot_workers, executor=plot_executor)
+    print(f"數據已保存到 {path}（{rows:,} 個時段）")
+    return rows
+
+SIMULATION_CACHE_VERSION = 2  # 生成邏輯改變時遞增，讓舊快取失效
+_code_version = None
+
+def code_version():
+    """本模組原始碼的雜湊值，程式碼改變時快取自動失效。"""
+    global _code_version
+    if _code_version is None:
+        with open(os.path.abspath(__file__), "rb") as file:
+            _code_version = hashlib.sha256(file.read()).hexdigest()
+    return _code_version
+
+class MonthCache:
+    """
+    以內容雜湊為鍵的月份結果快取。鍵由影響該電表月份的設定值、隨機種子與程式碼版本組成，
+    設定未改變的月份直接以 memory-mapped 陣列讀回，不需重新生成。
+    快取總大小超過上限時，依最近使用時間（LRU）淘汰舊檔案。
+    """
+
+    def __init__(self, directory=".simulation_cache", max_bytes=512 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def month_key(self, pipeline, meter_no, year, month, entropy, max_demand_limits, reference_totals, peak_values):
+        """
+        計算快取鍵。
+
+        參數：
+            pipeline (str): 產生結果的流程，例如 "single" 或 "fleet"
+            meter_no (str): 電表編號
+            year, month (int): 年月
+            entropy (int): 隨機種子 entropy
+            max_demand_limits (np.ndarray): 該月各時段最高需量限制
+            reference_totals (np.ndarray): 該月各時段參考總需量
+            peak_values (dict): 該月的峰值
+
+        返回：
+            str: 十六進位雜湊值
+        """
+        config = get_config()
+        payload = {
+            "version": SIMULATION_CACHE_VERSION,
+            "code": code_version(),
+            "pipeline": pipeline,
+            "meter_no": meter_no,
+            "year": year,
+            "month": month,
+            "entropy": str(entropy),
+            "base_demand_range": list(config.base_demand_range),
+            "low_demand": [config.low_demand_start, config.low_demand_end, list(config.low_demand_range)],
+            "max_demand_limits": np.asarray(max_demand_limits, dtype=float).tolist(),
+            "reference_totals": np.asarray(reference_totals, dtype=float).tolist(),
+            "peak_values": sorted(peak_values.items())
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.npy")
+
+    @traced("cache_load")
+    def load(self, key):
+        """讀取快取的需量陣列（唯讀 memmap），沒有快取時回傳 None。"""
+        path = self.path(key)
+        try:
+            demand = np.load(path, mmap_mode="r")
+            os.utime(path)  # 更新最近使用時間
+        except (OSError, ValueError):
+            return None
+        trace_count(rows=demand.size, bytes_read=demand.nbytes)
+        return demand
+
+    @traced("cache_store")
+    def store(self, key, demand):
+        """寫入快取（先寫暫存檔再改名，可供多個 worker 同時使用），並淘汰超出大小上限的舊檔案。"""
+        path = self.path(key)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as file:
+            np.save(file, np.asarray(demand))
+        os.replace(temporary_path, path)
+        trace_count(rows=np.size(demand), bytes_written=np.asarray(demand).nbytes)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npy"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+def open_month_cache(cache_dir, cache_size_mb):
+    return MonthCache(cache_dir, int(cache_size_mb * 1024 * 1024)) if cache_dir else None
+
+def month_year(month):
+    """依該月 PEAK_VALUES 的日期決定年份，沒有 PEAK_VALUES 時為 DEFAULT_YEAR。"""
+    config = get_config()
+    peak_values = config.peak_values.get(month, {})
+    if peak_values:
+        return datetime.strptime(next(iter(peak_values)), "%Y-%m-%d %H:%M").year
+    return DEFAULT_YEAR
+
+def meter_key(meter_no):
+    """將電表編號轉為穩定的整數，作為 SeedSequence 的 spawn_key。"""
+    return int.from_bytes(hashlib.sha256(str(meter_no).encode("utf-8")).digest()[:8], "little")
+
+def meter_month_rng(entropy, meter_no, year, month):
+    """
+    每個 (電表, 年, 月) 使用由同一個 entropy 衍生的獨立隨機數流。
+    任一電表月份都能單獨重新生成並得到相同結果，與依序、平行或部分執行無關。
+    """
+    return np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=(meter_key(meter_no), year, month)))
+
+def run_month(year, month, entropy, plot=True, plot_workers=1, plot_mode="daily", cache_dir=None, cache_size_mb=512,
+              compression=None, sink=None):
+    """
+    執行單月完整流程並寫出該月的輸出分割（CSV 與圖表），可在 worker 行程中執行。
+
+    參數：
+        year (int): 年份
+        month (int): 月份
+        entropy (int): 本次執行的隨機種子 entropy
+        plot (bool): 是否繪製圖表
+        plot_workers (int): 繪製每日圖表的行程數
+        plot_mode (str): "daily" 每天一張圖，"monthly" 整月一張小圖矩陣
+        cache_dir (str): 月份結果快取目錄，None 表示不使用快取
+        cache_size_mb (float): 快取大小上限 (MB)
+        compression (str): CSV 的壓縮格式，None、"gzip" 或 "zstd"
+        sink (OutputSink): 共用的背景寫出器，None 時自行建立並在返回前寫完
+
+    返回：
+        tuple: (year, month, dict: 欄位陣列, str: 該月的輸出訊息)
+    """
+    config = get_config()
+    peak_values = config.peak_values.get(month, {})
+    cache = open_month_cache(cache_dir, cache_size_mb)
+
+    log = io.StringIO()
+    sink_scope = OutputSink(compression) if sink is None else contextlib.nullcontext(sink)
+    with sink_scope as sink, trace_context(year=year, month=month, meter_no=config.meter_no), trace_stage("run_month"), \
+            contextlib.redirect_stdout(log):
+        demand = None
+        if cache is not None:
+            key = cache.month_key("single", config.meter_no, year, month, entropy, config.max_demand_limits_table[month],
+                                  config.reference_total_demands_table[month], peak_values)
+            demand = cache.load(key)
+
+        if demand is not None:
+            columns = calendar_columns(date(year, month, 1), date(year, month, month_days(year, month)))[0]
+            columns["demand_kW"] = demand
+            print(f"\n{year}-{month:02d} 設定未改變，使用快取結果")
+            compare_energy_with_reference(calculate_monthly_stats_arrays(columns), config.reference_total_demands[month], year, month)
         else:
-            # 沒有 PEAK_VALUES 時，生成數據（不指定 peak_time 和 peak_value）
-            year = 2024  # 假設年份為 2024
-            days_in_month = MONTHS.get(month, 31)
-            all_month_data = generate_daily_demand_data(
-                year=year,
-                month=month,
-                start_day=1,
-                end_day=days_in_month,
-                peak_time=None,
-                peak_value=None
-            )
+            rng = meter_month_rng(entropy, config.meter_no, year, month)
+            columns, monthly_stats, differences = simulate_month(year, month, peak_values, rng=rng)
+            if cache is not None:
+                cache.store(key, columns["demand_kW"])
+
+        bill = calculate_bills(columns)[0]
+        print(f"電費估算：流動電費 {bill['energy_charge']:,.2f} 元，基本電費 {bill['basic_charge']:,.2f} 元，合計 {bill['total']:,.2f} 元")
+
+        filename = sink.write(f"factory_demand_data{year}_{month}.csv", columns)
+        print(f"數據已保存到 {filename}")
+
+        if plot:
+            plot_demand_arrays(columns, year, month, workers=plot_workers, mode=plot_mode)
+
+    flush_trace()
+    return year, month, columns, log.getvalue()
+
+def load_meter_registry(path):
+    """
+    讀取電表清單 JSON 檔，每個電表可各自設定參數，未設定的參數沿用 config.txt。
+
+    格式：
+        {"meters": [
+            {"meter_no": "07281937401",
+             "max_demand_limits": {"4": {"Peak": 0, "Half_Peak": 32937, ...}, ...},
+             "reference_total_demands": {"4": {"Peak": 0, "Half_Peak": 7385280, ...}, ...},
+             "peak_values": {"2024-04-01 22:30": 25190, ...}},
+            ...
+        ]}
 
-            filename = f"factory_demand_data{year}_{month}.csv"
-            write_to_csv(filename, all_month_data)
+    返回：
+        list: 每個電表的 {"meter_no", "max_demand_limits", "reference_total_demands", "peak_values"}，
+            其中兩個表格為 (13, 4) 陣列
+    """
+    config = get_config()
+    with open(path, "r", encoding="utf-8") as file:
+        registry = json.load(file)
+
+    default_peak_values = {}
+    for peak_values in config.peak_values.values():
+        default_peak_values.update(peak_values)
+
+    meters = []
+    for entry in registry["meters"]:
+        meters.append({
+            "meter_no": str(entry["meter_no"]),
+            "max_demand_limits": monthly_period_table(entry.get("max_demand_limits", {}), config.max_demand_limits_table),
+            "reference_total_demands": monthly_period_table(entry.get("reference_total_demands", {}), config.reference_total_demands_table),
+            "peak_values": entry.get("peak_values", default_peak_values)
+        })
+    return meters
+
+def month_peak_values(peak_values, year, month):
+    """只保留指定年月的峰值。"""
+    prefix = f"{year}-{month:02d}-"
+    return {time_str: value for time_str, value in peak_values.items() if time_str.startswith(prefix)}
+
+@traced("simulate_fleet_month")
+def simulate_fleet_month(meters, year, month, rng=None):
+    """
+    多電表的單月流程：批次生成所有電表 → 依各電表參考值調整，全程以 (電表數, 時段數) 陣列處理。
+
+    參數：
+        meters (list): load_meter_registry 回傳的電表清單
+        year (int): 年份
+        month (int): 月份
+        rng (list): 各電表的隨機數產生器
+
+    返回：
+        tuple: (dict: 欄位陣列, np.ndarray: 調整後各電表各時段與參考值的差額 (kW))
+    """
+    peak_values_list = [month_peak_values(meter["peak_values"], year, month) for meter in meters]
+    max_demand_limits = np.stack([meter["max_demand_limits"] for meter in meters])
+    reference_totals = np.stack([meter["reference_total_demands"][month] for meter in meters])
+
+    columns = generate_fleet_arrays(
+        date(year, month, 1),
+        date(year, month, month_days(year, month)),
+        max_demand_limits,
+        peak_values_list,
+        rng=rng
+    )
+    adjust_fleet_arrays(columns, reference_totals, max_demand_limits[:, month], peak_values_list)
+    totals, _ = calculate_fleet_stats_arrays(columns)
+    differences = np.round(totals - reference_totals / 0.25, 2)
+
+    reference_sum = reference_totals.sum(axis=1) / 0.25
+    percentage = np.divide(differences.sum(axis=1), reference_sum, out=np.zeros(len(meters)), where=reference_sum != 0) * 100
+    print(f"{year}-{month:02d}：{len(meters)} 個電表，總用電與參考值最大偏差 {np.abs(percentage).max():.2f}%")
+    return columns, differences
+
+@traced("simulate_scenarios")
+def simulate_scenarios(year, month, scenario_count, percentiles=SCENARIO_PERCENTILES, rng=None, contract_capacities=None,
+                       calibrate=False, batch_size=SCENARIO_BATCH_SIZE):
+    """
+    蒙地卡羅情境：以多電表的批次流程一次生成 (情境 × 時段) 需量陣列，計算每條路徑的電費與各時段最高需量，
+    回傳其分布。每批最多 batch_size 條路徑，不逐條執行單一路徑的流程。
+    calibrate 為 True 時每條路徑先校準到參考值；流動電費只取決於各時段的總用電，校準後每條路徑都相同，
+    因此只回傳平均值，不回傳百分位數。基本電費只取決於契約容量，同樣只回傳固定值。
+
+    參數：
+        year (int): 年份
+        month (int): 月份
+        scenario_count (int): 情境數，至少為 1
+        percentiles (tuple): 要回傳的百分位數
+        rng (np.random.Generator): 隨機數產生器，None 時使用模組預設產生器；抽樣結果與 batch_size 無關
+        contract_capacities (dict): 各契約類別的契約容量，None 時使用 DEFAULT_CONTRACT_CAPACITIES
+        calibrate (bool): 是否將每條路徑校準到 REFERENCE_TOTAL_DEMANDS
+        batch_size (int): 每批的情境數
+
+    返回：
+        dict: {"scenarios", "percentiles", "calibrated", "energy_charge", "basic_charge", "total", "max_demand_kW": {時段: ...}}，
+            各項為 {"mean", "p5", "p50", ...}；basic_charge 與校準時的 energy_charge 只有 "mean"
+    """
+    if scenario_count < 1:
+        raise ValueError(f"情境數必須至少為 1，收到 {scenario_count}")
+    config = get_config()
+    rng = _rng if rng is None else rng
+    peak_values = config.peak_values.get(month, {})
+    start_date, end_date = date(year, month, 1), date(year, month, month_days(year, month))
+
+    energy_charge = np.empty(scenario_count)
+    basic_charge = np.empty(scenario_count)
+    maxima = np.empty((scenario_count, len(PERIODS)))
+    for first in range(0, scenario_count, batch_size):
+        count = min(batch_size, scenario_count - first)
+        columns = generate_fleet_arrays(start_date, end_date, np.broadcast_to(config.max_demand_limits_table, (count, 13, len(PERIODS))),
+                                        [peak_values] * count, rng=rng)
+        if calibrate:
+            adjust_fleet_arrays(columns, np.broadcast_to(config.reference_total_demands_table[month], (count, len(PERIODS))),
+                                np.broadcast_to(config.max_demand_limits_table[month], (count, len(PERIODS))), [peak_values] * count)
+        bill = calculate_bills(columns, contract_capacities)[0]
+        energy_charge[first:first + count] = bill["energy_charge"]
+        basic_charge[first:first + count] = bill["basic_charge"]
+        maxima[first:first + count] = PeriodStats.from_columns(columns).maxima
+
+    def distribution(values):
+        summary = {"mean": round(float(values.mean()), 2)}
+        for q, value in zip(percentiles, np.percentile(values, percentiles, axis=0)):
+            summary[f"p{q:g}"] = round(float(value), 2)
+        return summary
+
+    return {
+        "scenarios": scenario_count,
+        "percentiles": tuple(percentiles),
+        "calibrated": calibrate,
+        "energy_charge": {"mean": round(float(energy_charge.mean()), 2)} if calibrate else distribution(energy_charge),
+        "basic_charge": {"mean": round(float(basic_charge.mean()), 2)},
+        "total": distribution(energy_charge + basic_charge),
+        "max_demand_kW": {name: distribution(maxima[:, code]) for code, name in enumerate(PERIODS)}
+    }
 
-        print(f"初始數據已保存到 {filename}")
+def print_scenario_summary(year, month, summary):
+    names = [f"p{q:g}" for q in summary["percentiles"]] + ["mean"]
+    print(f"\n{year}-{month:02d}：{summary['scenarios']:,} 個情境")
+    if summary["calibrated"]:
+        print("警告：路徑已校準到參考值，流動電費在各情境間相同，不列出其百分位數")
+    print("  基本電費只取決於契約容量，各情境相同，只列出固定值")
+    print(f"  {'項目':<24}" + "".join(f"{name:>16}" for name in names))
+    rows = [("流動電費 (元)", summary["energy_charge"]), ("基本電費 (元)", summary["basic_charge"]), ("合計 (元)", summary["total"])]
+    rows += [(f"{PERIOD_LABELS[name]}最高需量 (kW)", values) for name, values in summary["max_demand_kW"].items()]
+    for label, values in rows:
+        print(f"  {label:<24}" + "".join(f"{values[name]:>16,.2f}" if name in values else f"{'—':>16}" for name in names))
+
+@traced("write_fleet_partitions")
+def write_fleet_partitions(columns, meters, year, month, output_dir, partition_format="csv", sink=None):
+    """
+    依電表分割寫出數據：
+        "csv": output_dir/meter=<meter_no>/factory_demand_data{year}_{month}.csv（有 sink 時交給背景執行緒寫出）
+        "binary": output_dir/meter=<meter_no>/{year}-{month:02d}.dmd，可直接以 IntervalDemandStore(output_dir) 讀取
+    """
+    for meter_index, meter in enumerate(meters):
+        partition = os.path.join(output_dir, f"meter={meter['meter_no']}")
+        os.makedirs(partition, exist_ok=True)
+        meter_columns = dict(columns, demand_kW=columns["demand_kW"][meter_index])
+        with trace_context(meter_no=meter["meter_no"]):
+            if partition_format == "binary":
+                write_interval_file(os.path.join(partition, f"{year}-{month:02d}.dmd"), meter_columns, meter["meter_no"])
+            elif sink is not None:
+                sink.write(os.path.join(partition, f"factory_demand_data{year}_{month}.csv"), meter_columns, meter["meter_no"])
+            else:
+                write_columns_to_csv(os.path.join(partition, f"factory_demand_data{year}_{month}.csv"), meter_columns, meter["meter_no"])
+
+def run_fleet_month(year, month, entropy, meters, output_dir, cache_dir=None, cache_size_mb=512, partition_format="csv",
+                    compression=None, sink=None, contract_sweep=False):
+    """
+    執行多電表的單月流程並寫出各電表的分割，可在 worker 行程中執行。
+    使用快取時只重新生成設定有改變的電表。CSV 分割由 sink（None 時自行建立）在背景寫出。
+
+    返回：
+        tuple: (year, month, str: 該月的輸出訊息, ContractCapacityProfile: contract_sweep 為 True 時該月的契約容量試算資料，否則為 None)
+    """
+    cache = open_month_cache(cache_dir, cache_size_mb)
+    log = io.StringIO()
+    sink_scope = OutputSink(compression) if sink is None else contextlib.nullcontext(sink)
+    with sink_scope as sink, trace_context(year=year, month=month), trace_stage("run_fleet_month"), contextlib.redirect_stdout(log):
+        columns = calendar_columns(date(year, month, 1), date(year, month, month_days(year, month)))[0]
+        demand = np.empty((len(meters), len(columns["date"])))
+        keys, dirty = [], []
+        for meter_index, meter in enumerate(meters):
+            cached = None
+            if cache is not None:
+                key = cache.month_key("fleet", meter["meter_no"], year, month, entropy, meter["max_demand_limits"][month],
+                                      meter["reference_total_demands"][month], month_peak_values(meter["peak_values"], year, month))
+                keys.append(key)
+                cached = cache.load(key)
+            if cached is None:
+                dirty.append(meter_index)
+            else:
+                demand[meter_index] = cached
+
+        if dirty:
+            dirty_meters = [meters[meter_index] for meter_index in dirty]
+            rng = [meter_month_rng(entropy, meter["meter_no"], year, month) for meter in dirty_meters]
+            dirty_columns, _ = simulate_fleet_month(dirty_meters, year, month, rng=rng)
+            demand[dirty] = dirty_columns["demand_kW"]
+            if cache is not None:
+                for meter_index, meter_demand in zip(dirty, dirty_columns["demand_kW"]):
+                    cache.store(keys[meter_index], meter_demand)
+        print(f"{year}-{month:02d}：重新生成 {len(dirty)} 個電表，{len(meters) - len(dirty)} 個使用快取")
+
+        columns["demand_kW"] = demand
+        write_fleet_partitions(columns, meters, year, month, output_dir, partition_format, sink)
+        profile = ContractCapacityProfile.from_columns(columns) if contract_sweep else None
+    flush_trace()
+    return year, month, log.getvalue(), profile
+
+def main(store_path="factory_demand_data.db", workers=1, seed=None, meters=None, output_dir="fleet_output",
+         plot_workers=1, plot_mode="daily", months=None, cache_dir=".simulation_cache", cache_size_mb=512,
+         config_path=None, plot=True, partition_format="csv", trace_dir=None, trace_memory=False, year=None,
+         start=None, end=None, chunk_days=STREAM_CHUNK_DAYS, compression=None, scenarios=None, calibrate=False,
+         contract_sweep=False):
+    """
+    模擬 1 月到 12 月的需量數據。
 
-        monthly_stats = calculate_monthly_stats_from_csv(filename, year, month)
-        differences = compare_energy_with_reference(monthly_stats, REFERENCE_TOTAL_DEMANDS, year, month)
-        max_demand_limits = MAX_DEMAND_LIMITS_DICT[month]
-        adjust_demand_from_csv(filename, differences, max_demand_limits, PEAK_VALUES)
-        monthly_stats = calculate_monthly_stats_from_csv(filename, year, month)
-        differences = compare_energy_with_reference(monthly_stats, REFERENCE_TOTAL_DEMANDS, year, month)
-        plot_demand_data(filename, year, month)
+    參數：
+        store_path (str): 儲存層路徑
+        workers (int): 平行處理的行程數，1 表示在目前行程依序執行
+        seed (int): 隨機種子，None 時隨機產生並印出；相同種子下每個電表月份的結果固定，
+            與 workers 數量及是否只執行部分月份無關
+        meters (str): 電表清單 JSON 路徑；指定時改為多電表模式，依電表分割寫到 output_dir
+        output_dir (str): 多電表模式的輸出目錄
+        plot_workers (int): 依序處理月份時，繪製每日圖表的行程數（平行處理月份時各 worker 自行依序繪製）
+        plot_mode (str): "daily" 每天一張圖，"monthly" 每月一張小圖矩陣
+        months (list): 只執行指定的月份，None 時執行 1 月到 12 月
+        cache_dir (str): 月份結果快取目錄，None 表示不使用快取；未指定 seed 時不使用快取
+        cache_size_mb (float): 快取大小上限 (MB)，超過時淘汰最久未使用的月份
+        config_path (str): 設定檔路徑（config.txt、.json 或 .toml），None 時為 CONFIG_PATH
+        plot (bool): 是否繪製圖表；False 時只輸出 CSV 與電費，完全不載入 matplotlib
+        partition_format (str): 多電表模式的輸出格式，"csv" 或 "binary"（二進位時段檔）
+        trace_dir (str): 效能追蹤輸出目錄，None 表示不追蹤；各行程的紀錄合併為 trace.csv 與 trace_summary.json
+        trace_memory (bool): 追蹤時是否以 tracemalloc 量測各階段的峰值記憶體（較慢）
+        year (int): 模擬的年份，None 時依各月 PEAK_VALUES 的日期決定
+        start (str): 串流模式的起始日期或時間，例如 "2024-01-01" 或 "2024-01-01 08:00"；指定時不依月份執行，
+            改以 run_stream 逐塊處理 start 到 end，記憶體與期間長度無關
+        end (str): 串流模式的結束日期或時間（含）
+        chunk_days (int): 串流模式每塊的天數
+        compression (str): CSV 輸出的壓縮格式，None、"gzip" 或 "zstd"；CSV 一律由背景執行緒寫出
+        scenarios (int): 指定時改為蒙地卡羅情境模式，各月份生成 scenarios 條路徑並印出電費與最高需量的分布，不寫出數據
+        calibrate (bool): 情境模式中是否將每條路徑校準到參考值（校準後流動電費固定，只印出平均值）
+        contract_sweep (bool): 是否在執行後以 ContractCapacityProfile 試算經常契約容量並印出最佳值
+    """
+    load_config(config_path)
+    if trace_dir is not None:
+        enable_tracing(trace_dir, memory=trace_memory)
+    entropy = np.random.SeedSequence(seed).entropy
+    print(f"隨機種子：{entropy}")
+    if seed is None:
+        cache_dir = None  # 隨機產生的種子不會再次出現，讀寫快取只會白費時間與空間
+    tasks = [(year or month_year(month), month) for month in (months or range(1, 13))]  # 1 月到 12 月
+
+    profile = ContractCapacityProfile() if contract_sweep else None
+    try:
+        if scenarios is not None:
+            for year, month in tasks:
+                rng = meter_month_rng(entropy, "scenarios", year, month)
+                with trace_context(year=year, month=month), contextlib.redirect_stdout(io.StringIO()):
+                    summary = simulate_scenarios(year, month, scenarios, rng=rng, calibrate=calibrate)
+                print_scenario_summary(year, month, summary)
+            return
+
+        if start is not None:
+            with open_demand_store(store_path) as store:
+                run_stream(start, end or start, entropy, store, chunk_days, plot=plot, plot_workers=plot_workers, compression=compression,
+                           profile=profile)
+            print_contract_sweep(profile)
+            return
+
+        if meters is not None:
+            registry = load_meter_registry(meters)
+            if workers > 1:
+                with worker_pool(workers) as executor:
+                    futures = [executor.submit(run_fleet_month, year, month, entropy, registry, output_dir, cache_dir, cache_size_mb,
+                                               partition_format, compression, contract_sweep=contract_sweep) for year, month in tasks]
+                    for future in futures:
+                        year, month, log, month_profile = future.result()
+                        print(log, end="")
+                        if profile is not None:
+                            profile.merge(month_profile)
+            else:
+                # 同一個寫出器跨月份使用，上個月的分割在背景寫出時即開始生成下個月
+                with OutputSink(compression) as sink:
+                    for year, month in tasks:
+                        year, month, log, month_profile = run_fleet_month(year, month, entropy, registry, output_dir, cache_dir,
+                                                                          cache_size_mb, partition_format, sink=sink,
+                                                                          contract_sweep=contract_sweep)
+                        print(log, end="")
+                        if profile is not None:
+                            profile.merge(month_profile)
+            print_contract_sweep(profile, [meter["meter_no"] for meter in registry])
+            return
+
+        with open_demand_store(store_path) as store:
+            if workers > 1:
+                with worker_pool(workers) as executor:
+                    futures = [executor.submit(run_month, year, month, entropy, plot=plot, plot_mode=plot_mode,
+                                               cache_dir=cache_dir, cache_size_mb=cache_size_mb, compression=compression) for year, month in tasks]
+                    results = (future.result() for future in futures)
+                    for year, month, columns, log in results:
+                        print(log, end="")
+                        with trace_context(year=year, month=month):
+                            store.upsert_columns(columns)
+                        if profile is not None:
+                            profile.update(columns)
+            else:
+                with OutputSink(compression) as sink:
+                    for year, month in tasks:
+                        year, month, columns, log = run_month(year, month, entropy, plot=plot, plot_workers=plot_workers, plot_mode=plot_mode,
+                                                               cache_dir=cache_dir, cache_size_mb=cache_size_mb, sink=sink)
+                        print(log, end="")
+                        with trace_context(year=year, month=month):
+                            store.upsert_columns(columns)
+                        if profile is not None:
+                            profile.update(columns)
+        print_contract_sweep(profile)
+    finally:
+        if trace_dir is not None:
+            disable_tracing()
+            print_trace_summary(summarize_trace(trace_dir), trace_dir)
+
+def print_contract_sweep(profile, meter_nos=None):
+    """印出契約容量試算的最佳值與目前契約容量 (DEFAULT_CONTRACT_CAPACITIES) 的成本，profile 為 None 時不做任何事。"""
+    if profile is None or not profile.months:
+        return
+    current = DEFAULT_CONTRACT_CAPACITIES["Contract"]
+    result = profile.sweep()
+    current_cost = profile.costs([current])[:, 0]
+    optimal_capacity, optimal_cost = result["optimal_capacity"], result["optimal_cost"]
+    print(f"\n契約容量試算（{len(profile.months)} 個計費月份，基本電費 + 超約附加費）：")
+    if profile.meter_count == 1:
+        print(f"  最佳經常契約容量 {optimal_capacity[0]:,.0f} kW，成本 {optimal_cost[0]:,.2f} 元；"
+              f"目前 {current:,} kW 為 {current_cost[0]:,.2f} 元")
+        step = max(1, len(result["capacities"]) // 10)
+        for capacity, cost in zip(result["capacities"][::step], result["costs"][0][::step]):
+            print(f"  {capacity:>12,.0f} kW {cost:>20,.2f} 元")
+        return
+    print(f"  {profile.meter_count} 個電表，最佳契約容量中位數 {np.median(optimal_capacity):,.0f} kW"
+          f"（{optimal_capacity.min():,.0f} 至 {optimal_capacity.max():,.0f} kW）")
+    print(f"  合計成本 {optimal_cost.sum():,.2f} 元；全部使用目前 {current:,} kW 為 {current_cost.sum():,.2f} 元")
+    if meter_nos is not None:
+        savings = current_cost - optimal_cost
+        for meter_index in np.argsort(-savings)[:5]:
+            print(f"  {meter_nos[meter_index]}：最佳 {optimal_capacity[meter_index]:,.0f} kW，可節省 {savings[meter_index]:,.2f} 元")
+
+def print_trace_summary(summary, trace_dir):
+    print(f"\n效能追蹤（{trace_dir}/trace.csv、trace_summary.json）：")
+    print(f"  {'階段':<34}{'呼叫':>8}{'秒':>10}{'筆數':>12}{'讀取 MB':>10}{'寫入 MB':>10}{'圖表':>6}{'峰值 MB':>10}")
+    for stage, entry in sorted(summary.items(), key=lambda item: -item[1]["seconds"]):
+        print(f"  {stage:<34}{entry['calls']:>8,}{entry['seconds']:>10.3f}{entry['rows']:>12,}{entry['bytes_read'] / 2 ** 20:>10.2f}"
+              f"{entry['bytes_written'] / 2 ** 20:>10.2f}{entry['figures']:>6}{entry['peak_memory_bytes'] / 2 ** 20:>10.2f}")
+
+def positive_int(value):
+    """argparse 的型別檢查：至少為 1 的整數。"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"必須至少為 1，收到 {value}")
+    return number
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="工廠需量模擬")
+    parser.add_argument("--config", dest="config_path", default=None, help="設定檔路徑（config.txt、.json 或 .toml）")
+    parser.add_argument("--store", dest="store_path", default="factory_demand_data.db", help="儲存層路徑（.db、.csv 或 .dmd 目錄；串流模式不支援 .csv）")
+    parser.add_argument("--workers", type=int, default=1, help="平行處理的行程數")
+    parser.add_argument("--seed", type=int, default=None, help="隨機種子，可重現整次或部分月份的結果")
+    parser.add_argument("--months", type=int, nargs="+", default=None, help="只執行指定的月份，例如 --months 4 7")
+    parser.add_argument("--year", type=int, default=None, help="模擬的年份，預設依 PEAK_VALUES 的日期決定")
+    parser.add_argument("--start", default=None, help="串流模式的起始日期或時間，例如 2024-01-01 或 \"2024-01-01 08:00\"")
+    parser.add_argument("--end", default=None, help="串流模式的結束日期或時間（含），例如 2033-12-31")
+    parser.add_argument("--chunk-days", type=int, default=STREAM_CHUNK_DAYS, help="串流模式每塊的天數")
+    parser.add_argument("--scenarios", type=positive_int, default=None, help="蒙地卡羅情境數，指定時只印出各月電費與最高需量的分布")
+    parser.add_argument("--calibrate", action="store_true", help="情境模式將每條路徑校準到參考值（流動電費只印出平均值）")
+    parser.add_argument("--contract-sweep", action="store_true", help="執行後試算經常契約容量的成本曲線與最佳值")
+    parser.add_argument("--meters", default=None, help="電表清單 JSON 路徑（多電表模式）")
+    parser.add_argument("--output-dir", default="fleet_output", help="多電表模式的輸出目錄")
+    parser.add_argument("--partition-format", choices=("csv", "binary"), default="csv", help="多電表模式的輸出格式")
+    parser.add_argument("--compression", choices=("gzip", "zstd"), default=None, help="CSV 輸出的壓縮格式（zstd 需安裝 zstandard）")
+    parser.add_argument("--plot-workers", type=int, default=1, help="繪製每日圖表的行程數")
+    parser.add_argument("--plot-mode", choices=["daily", "monthly"], default="daily", help="每天一張圖或每月一張小圖矩陣")
+    parser.add_argument("--no-plot", dest="plot", action="store_false", help="不繪製圖表，只輸出 CSV 與電費")
+    parser.add_argument("--cache-dir", default=".simulation_cache", help="月份結果快取目錄")
+    parser.add_argument("--no-cache", dest="cache_dir", action="store_const", const=None, help="不使用月份結果快取")
+    parser.add_argument("--cache-size-mb", type=float, default=512, help="快取大小上限 (MB)")
+    parser.add_argument("--trace", dest="trace_dir", default=None, help="效能追蹤輸出目錄（各階段時間、筆數、讀寫位元組與圖表數）")
+    parser.add_argument("--trace-memory", action="store_true", help="追蹤時一併量測各階段的峰值記憶體")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main(**vars(parse_args()))